@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from db import ytarchive
-from sqlalchemy_declarative import SessionSchema, FileSchema, LogSchema
+from sqlalchemy_declarative import SessionSchema, FileSchema, LogSchema, LogSummarySchema
 from flask.views import MethodView
 from flask import request, abort, jsonify
 from collections import OrderedDict
@@ -9,52 +9,81 @@ from collections import OrderedDict
 
 class Sessions(MethodView):
     def get(self, id=None):
+        next_cursor = None
         try:
-            data = ytarchive().sessionsGet(id, request.args)
+            if id:
+                data = ytarchive().sessionsGet(id)
+            else:
+                data, next_cursor = ytarchive().sessionsGetPage(request.args)
         except ValueError as e:
             abort(400, str(e))
 
         schema = SessionSchema() if id else SessionSchema(many=True)
         data = schema.dump(data)
 
-        return response(results=data, id=id, type='session')
+        return response(results=data, id=id, type='session', next_cursor=next_cursor)
 
 
 class Files(MethodView):
     def get(self, id=None):
+        next_cursor = None
         try:
-            data = ytarchive().filesGet(id, request.args)
+            if id:
+                data = ytarchive().filesGet(id)
+            else:
+                data, next_cursor = ytarchive().filesGetPage(request.args)
         except ValueError as e:
             abort(400, str(e))
 
         schema = FileSchema() if id else FileSchema(many=True)
         data = schema.dump(data)
 
-        return response(results=data, id=id, type='file')
+        return response(results=data, id=id, type='file', next_cursor=next_cursor)
 
 
 class Logs(MethodView):
     def get(self, id=None):
+        next_cursor = None
         try:
-            data = ytarchive().logsGet(id, request.args)
+            if id:
+                data = ytarchive().logsGet(id)
+            else:
+                data, next_cursor = ytarchive().logsGetPage(request.args)
         except ValueError as e:
             abort(400, str(e))
 
         schema = LogSchema() if id else LogSchema(many=True)
         data = schema.dump(data)
 
-        return response(results=data, id=id, type='log')
+        return response(results=data, id=id, type='log', next_cursor=next_cursor)
 
 
-def response(results, id, type):
+class LogSummaries(MethodView):
+    def get(self):
+        try:
+            data, next_cursor = ytarchive().logSummariesGetPage(request.args)
+        except ValueError as e:
+            abort(400, str(e))
+
+        data = LogSummarySchema(many=True).dump(data)
+
+        return response(results=data, id=None, type='log summary', next_cursor=next_cursor, plural='log summaries')
+
+
+class Pool(MethodView):
+    def get(self):
+        return jsonify(ytarchive().poolStatus()), 200
+
+
+def response(results, id, type, next_cursor=None, plural=None):
     if not results.data:
         if id is None:
-            abort(404, "No " + type + "s found")
+            abort(404, "No " + (plural or type + "s") + " found")
         else:
             abort(404, "No " + type + " found with the id: " + id)
     else:
-        response = OrderedDict(
-            size=len(results.data),
-            results=results.data
-        )
+        response = OrderedDict(size=len(results.data))
+        if id is None:
+            response['next'] = next_cursor
+        response['results'] = results.data
         return jsonify(response), 200
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from flask import Flask
-from api_resources import Sessions, Files, Logs
+from api_resources import Sessions, Files, Logs, LogSummaries, Pool
 import configparser
 from os import path
 
@@ -20,6 +20,12 @@ log_view = Logs.as_view('logs')
 app.add_url_rule('/api/logs/', defaults={'id': None}, view_func=log_view, methods=['GET', ])
 app.add_url_rule('/api/logs/<string:id>', view_func=log_view, methods=['GET', ])
 
+log_summary_view = LogSummaries.as_view('log_summaries')
+app.add_url_rule('/api/log_summaries/', view_func=log_summary_view, methods=['GET', ])
+
+pool_view = Pool.as_view('pool')
+app.add_url_rule('/api/pool', view_func=pool_view, methods=['GET', ])
+
 
 class Base():
 
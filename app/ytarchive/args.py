@@ -5,5 +5,6 @@ from argparse import ArgumentParser
 def get_args():
 	parser = ArgumentParser()
 	parser.add_argument("-s", "--site", help="limit operations to the provided site id", type=int)
+	parser.add_argument("-b", "--batch", help="number of sessions to claim and work through per run", type=int, default=1)
 	args = parser.parse_args()
 	return args
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import statistics
+import time
+from argparse import ArgumentParser
+import constants as c
+from db import ytarchive
+
+# seeded rows use ids far above anything Open.Media hands out so they can be
+# told apart from (and cleaned up without touching) real data
+BENCH_SITE_ID = 900000000
+BENCH_SESSION_ID = 900000000
+BENCH_SITES = 10
+
+
+def get_bench_args():
+    parser = ArgumentParser(description="Time the work queue and log queries against seeded data")
+    parser.add_argument("--logs", help="number of log rows to seed", type=int, default=1000000)
+    parser.add_argument("--sessions", help="number of sessions to seed", type=int, default=10000)
+    parser.add_argument("--repeat", help="number of timed runs per query", type=int, default=20)
+    parser.add_argument("--keep", help="keep seeded rows after the run", action="store_true")
+    return parser.parse_args()
+
+
+def bench_site_ids():
+    return [BENCH_SITE_ID + offset for offset in range(BENCH_SITES)]
+
+
+def seed_sessions(count):
+    """Spread sessions across sites and states with one file per session"""
+    states = [c.SESSION_NEW, c.SESSION_CHANGED, c.SESSION_PROCESSED, c.SESSION_SYNCED]
+    sessions = []
+    files = []
+    for offset in range(count):
+        session_id = BENCH_SESSION_ID + offset
+        sessions.append({
+            'id': session_id,
+            'site_id': BENCH_SITE_ID + offset % BENCH_SITES,
+            'title': "Benchmark session",
+            'state': states[offset % len(states)],
+            'created': offset,
+            'last_updated': offset,
+            'validated': 0})
+        files.append({
+            'id': "bench-" + str(session_id),
+            'session_id': session_id,
+            'type': 'agenda',
+            'url': "https://example.com/agenda.pdf",
+            'state': c.FILE_NEW})
+    ytarchive().sessionsInsert(sessions)
+    ytarchive().filesInsert(files)
+
+
+def seed_logs(count, sessions):
+    """Mostly session and file status rows with a harvest run per site every
+    hundred rows, written in chunks to bound memory
+    """
+    chunk = []
+    for offset in range(count):
+        if offset % 100 == 0:
+            chunk.append({
+                'time': offset,
+                'site_id': BENCH_SITE_ID + offset % BENCH_SITES,
+                'type': 'harvest_run',
+                'severity': c.LOG_STATUS,
+                'message': "Harvest run",
+                'state': 'harvesting'})
+        else:
+            chunk.append({
+                'time': offset,
+                'site_id': BENCH_SITE_ID + offset % BENCH_SITES,
+                'session_id': BENCH_SESSION_ID + offset % max(sessions, 1),
+                'file_id': None,
+                'type': 'session',
+                'severity': c.LOG_STATUS,
+                'message': "Benchmark status",
+                'state': c.SESSION_SYNCED})
+
+        if len(chunk) >= 10000:
+            ytarchive().logsInsert(chunk, return_ids=False)
+            chunk = []
+    if chunk:
+        ytarchive().logsInsert(chunk, return_ids=False)
+
+
+def cleanup():
+    site_ids = ','.join(str(site_id) for site_id in bench_site_ids())
+    ytarchive().logsDelete(params={'site_id': site_ids})
+    ytarchive().sessionsDelete(params={'site_id': site_ids})
+    ytarchive().filesDelete(params={'session_id:ge': BENCH_SESSION_ID})
+
+
+def time_query(query, repeat):
+    timings = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        query()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def bench_queries():
+    site_id = BENCH_SITE_ID
+    session_id = BENCH_SESSION_ID
+    return [
+        ('last_run_time', lambda: ytarchive().logsGet(id=None, params={'site_id': site_id, 'type': 'harvest_run', 'state': 'harvesting', 'sort': 'time:desc', 'limit': 1})),
+        ('logsGetSynced', lambda: ytarchive().logsGetSynced(session_id)),
+        ('sessionsGetChangedOldest', lambda: ytarchive().sessionsGetChangedOldest()),
+        ('sessionsGetChangedOldest(site)', lambda: ytarchive().sessionsGetChangedOldest(site_id)),
+        ('sessionsGetSyncedOldest', lambda: ytarchive().sessionsGetSyncedOldest()),
+        ('sessionProcessedOldest', lambda: ytarchive().sessionProcessedOldest()),
+        ('filesGetNewChanged', lambda: ytarchive().filesGetNewChanged(session_id)),
+    ]
+
+
+def benchmark():
+    args = get_bench_args()
+
+    print("Seeding " + str(args.sessions) + " sessions and " + str(args.logs) + " log rows")
+    start = time.perf_counter()
+    seed_sessions(args.sessions)
+    seed_logs(args.logs, args.sessions)
+    print("Seeded in %.1fs" % (time.perf_counter() - start))
+
+    try:
+        print("%-32s %10s %10s %10s" % ("query", "min ms", "median ms", "max ms"))
+        for name, query in bench_queries():
+            timings = time_query(query, args.repeat)
+            print("%-32s %10.2f %10.2f %10.2f" % (name, min(timings), statistics.median(timings), max(timings)))
+    finally:
+        if not args.keep:
+            cleanup()
+
+
+benchmark()
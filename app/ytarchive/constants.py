@@ -11,6 +11,7 @@ SESSION_REMOVED = "removed"
 SESSION_DELETED = "deleted"
 SESSION_FAILED = "failed"
 SESSION_SKIPPED = "skipped"
+SESSION_METADATA = "metadata"
 
 FILE_UNHARVESTED = "unharvested"
 FILE_NEW = "new"
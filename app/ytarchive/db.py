@@ -1,26 +1,210 @@
 #!/usr/bin/env python3
 
+import base64
 import configparser
+import json
+import os
+import socket
+import threading
+import time
+import uuid
 from os import path
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, or_
-from sqlalchemy_declarative import Session, File, Log
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, event, or_, and_, case, text
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy_declarative import Base, Session, File, Log, LogSummary, HarvestState
 import constants as c
 
+_engine = None
+_session_factory = None
+_settings = None
+_settings_lock = threading.Lock()
+_engine_lock = threading.Lock()
+_pool_stats = {'connects': 0, 'checkouts': 0, 'checkins': 0}
+_consecutive_insert_ids = None
+
+
+def settings():
+    """Load config.ini once per process"""
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                config_path = path.join(path.abspath(path.dirname(__file__)), 'config.ini')
+                config = configparser.ConfigParser()
+                config.read(config_path)
+                _settings = config
+    return _settings
+
+
+def engine_url(config):
+    """Database URL from the YTARCHIVE_DB_URL environment variable or the url
+    setting, otherwise the MySQL connection string built from config.ini
+    """
+    url = os.environ.get('YTARCHIVE_DB_URL') or config.get('youtube_archive_db', 'url', fallback=None)
+    if url:
+        return url
+
+    engine_string = 'mysql://' + config['youtube_archive_db']['user']
+    engine_string += ':' + config['youtube_archive_db']['passwd']
+    engine_string += '@' + config.get('youtube_archive_db', 'host', fallback='db:3306')
+    engine_string += '/' + config["youtube_archive_db"]["db"]
+    return engine_string
+
+
+def is_sqlite(url):
+    return url.startswith('sqlite')
+
+
+def engine_options(config, url):
+    """Connection pool settings, overridable in the youtube_archive_db section"""
+    options = {
+        'pool_size': config.getint('youtube_archive_db', 'pool_size', fallback=5),
+        'max_overflow': config.getint('youtube_archive_db', 'max_overflow', fallback=10),
+        'pool_recycle': config.getint('youtube_archive_db', 'pool_recycle', fallback=3600),
+        'pool_pre_ping': config.getboolean('youtube_archive_db', 'pool_pre_ping', fallback=True)}
+
+    if is_sqlite(url):
+        # connections are shared between threads through the pool, the busy
+        # timeout lets writers queue on the database lock instead of failing
+        busy_timeout = config.getint('youtube_archive_db', 'sqlite_busy_timeout', fallback=30)
+        options['connect_args'] = {'check_same_thread': False, 'timeout': busy_timeout}
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            # every connection to an in-memory database is a new database
+            options = {'connect_args': options['connect_args'], 'poolclass': StaticPool}
+        else:
+            options['poolclass'] = QueuePool
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers carry on while a worker writes, NORMAL sync is safe
+    under WAL and skips an fsync per commit
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
+def prepare_sqlite_schema(engine):
+    """Create the schema in a new SQLite database, or bring an existing one
+    up to date, so single node installs need no separate setup step
+    """
+    import migrations
+    with engine.connect() as connection:
+        if not engine.dialect.has_table(connection, Session.__tablename__):
+            Base.metadata.create_all(connection)
+            migrations.stamp(connection)
+        else:
+            for migration in migrations.pending_migrations(connection):
+                migrations.apply_migration(connection, migration)
+
+
+def count_pool_event(name):
+    def listener(*args):
+        _pool_stats[name] += 1
+    return listener
+
+
+def get_engine():
+    """Create the process wide engine and scoped session factory on first use"""
+    global _engine, _session_factory
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                config = settings()
+                url = engine_url(config)
+                engine = create_engine(url, **engine_options(config, url))
+                event.listen(engine, 'connect', count_pool_event('connects'))
+                event.listen(engine, 'checkout', count_pool_event('checkouts'))
+                event.listen(engine, 'checkin', count_pool_event('checkins'))
+                if is_sqlite(url):
+                    event.listen(engine, 'connect', set_sqlite_pragmas)
+                    prepare_sqlite_schema(engine)
+                _session_factory = scoped_session(sessionmaker(bind=engine))
+                _engine = engine
+    return _engine
+
+
+def insert_batch_size():
+    """Rows sent per multi-row INSERT statement"""
+    return settings().getint('youtube_archive_db', 'insert_batch_size', fallback=500)
+
+
+def max_bind_params():
+    """SQLite builds before 3.32 refuse statements with more than 999 bound
+    parameters, MySQL has no practical limit
+    """
+    if get_engine().dialect.name == 'sqlite':
+        return 999
+    return None
+
+
+def lease_seconds():
+    """How long a claimed session is reserved for a worker before another
+    worker may reclaim it
+    """
+    return settings().getint('workers', 'lease_seconds', fallback=21600)
+
+
+def worker_token():
+    """Identify this worker and this particular claim"""
+    worker_id = socket.gethostname() + ':' + str(os.getpid())
+    return worker_id + ':' + uuid.uuid4().hex[:8]
+
+
+def page_size_limits():
+    """Default and maximum number of rows returned per API page"""
+    config = settings()
+    default = config.getint('api', 'page_size', fallback=100)
+    maximum = config.getint('api', 'max_page_size', fallback=1000)
+    return default, maximum
+
+
+def encode_cursor(value, id):
+    """Opaque cursor pointing just past the row with this sort value and id"""
+    data = json.dumps([value, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Invalid cursor: " + cursor)
+    return value, id
+
+
+def get_session():
+    """Thread local database session bound to the shared engine"""
+    get_engine()
+    return _session_factory
+
 
 class ytarchive():
 
     def __init__(self):
-        config_path = path.join(path.abspath(path.dirname(__file__)), 'config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_path)
-
-        engine_string = 'mysql://' + config['youtube_archive_db']['user']
-        engine_string += ':' + config['youtube_archive_db']['passwd']
-        engine_string += '@db:3306/' + config["youtube_archive_db"]["db"]
-        engine = create_engine(engine_string)
-        DBSession = sessionmaker(bind=engine)
-        self.db = DBSession()
+        self.db = get_session()
+        # the session is shared by the thread, drop anything left behind by
+        # a previous call that raised before it could close
+        self.db.rollback()
+
+    def poolStatus(self):
+        """Current connection pool usage along with lifetime counters"""
+        pool = get_engine().pool
+        status = {}
+        if isinstance(pool, QueuePool):
+            status = {
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow()}
+        status.update(_pool_stats)
+        return status
 
     def sessionsGet(self, id=None, params=None):
         query = self.db.query(Session)
@@ -38,6 +222,19 @@ class ytarchive():
         self.db.close()
         return results
 
+    def sessionsGetStates(self, ids):
+        """Only the columns harvest compares against for the given session
+        ids, as (id, state, validated, last_updated, fingerprint) rows"""
+        columns = (Session.id, Session.state, Session.validated, Session.last_updated, Session.fingerprint)
+        results = []
+        for chunk in self.bindChunks(list(ids), 1):
+            results += self.db.query(*columns).filter(Session.id.in_(chunk)).all()
+        self.db.close()
+        return results
+
+    def sessionsGetPage(self, params):
+        return self.getPage(Session, params)
+
     def sessionsGetChangedOldest(self, site_id=None):
         query = self.db.query(Session)
         query = query.filter(or_(Session.state == c.SESSION_NEW, Session.state == c.SESSION_CHANGED))
@@ -65,23 +262,101 @@ class ytarchive():
         self.db.close()
         return results
 
-    def sessionsInsert(self, records):
-        multiple = True
-        if not isinstance(records, (list,)):
-            records = [records]
-            multiple = False
-
-        for index, record in enumerate(records):
-            newSession = Session(**record)
-            self.db.add(newSession)
-            self.db.commit()
-            records[index]['id'] = newSession.id
+    def sessionsClaimChanged(self, site_id=None, limit=1):
+        """Claim the oldest new or changed sessions for downloading"""
+        return self.sessionsClaim(
+            states=[c.SESSION_NEW, c.SESSION_CHANGED],
+            claim_state=c.SESSION_FETCHING,
+            reclaim_states=[c.SESSION_FETCHING, c.SESSION_FETCHED, c.SESSION_PROCESSING],
+            site_id=site_id,
+            limit=limit)
+
+    def sessionsClaimProcessed(self, site_id=None, limit=1):
+        """Claim the oldest processed sessions for syncing to archive.org"""
+        return self.sessionsClaim(
+            states=[c.SESSION_PROCESSED],
+            claim_state=c.SESSION_SYNCING,
+            reclaim_states=[c.SESSION_SYNCING],
+            site_id=site_id,
+            limit=limit)
+
+    def sessionsClaimMetadata(self, site_id=None, limit=1):
+        """Claim the oldest sessions waiting on a metadata only sync"""
+        return self.sessionsClaim(
+            states=[c.SESSION_METADATA],
+            site_id=site_id,
+            limit=limit)
+
+    def sessionsClaimSynced(self, site_id=None, limit=1):
+        """Claim the oldest synced sessions that still need validating"""
+        return self.sessionsClaim(
+            states=[c.SESSION_SYNCED, c.SESSION_DELETED],
+            site_id=site_id,
+            limit=limit,
+            filters=[Session.validated == 0])
+
+    def sessionsClaim(self, states, claim_state=None, reclaim_states=None, site_id=None, limit=1, filters=None):
+        """Atomically reserve up to limit of the oldest sessions in states for
+        this worker under a lease, optionally moving them to claim_state.
+        Sessions left in reclaim_states by a worker whose lease ran out are
+        picked up again. Each candidate is only taken if a conditional UPDATE
+        still finds it claimable, so concurrent workers never share a session.
+        """
+        now = int(time.time())
+        token = worker_token()
+        claimable = or_(
+            and_(Session.state.in_(states),
+                 or_(Session.lease_expires == None, Session.lease_expires < now)),  # noqa: E711
+            and_(Session.state.in_(reclaim_states or []),
+                 Session.lease_expires < now))
+
+        values = {'claimed_by': token, 'lease_expires': now + lease_seconds()}
+        if claim_state:
+            values['state'] = claim_state
+
+        claimed = 0
+        try:
+            # another worker may win some of the candidates, try again with
+            # the next oldest a few times before giving up
+            for attempt in range(3):
+                query = self.db.query(Session.id).filter(claimable)
+                if site_id:
+                    query = query.filter(Session.site_id == site_id)
+                for condition in filters or []:
+                    query = query.filter(condition)
+                query = query.order_by(Session.last_updated.asc()).limit(limit - claimed)
+                candidates = [row.id for row in query]
+                if not candidates:
+                    break
+
+                update = self.db.query(Session).filter(Session.id.in_(candidates)).filter(claimable)
+                claimed += update.update(values, synchronize_session=False)
+                self.db.commit()
+                if claimed >= limit:
+                    break
+
+            results = self.db.query(Session).filter(Session.claimed_by == token).order_by(Session.last_updated.asc()).all()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+        return results
 
+    def sessionsExtendLease(self, session):
+        """Push back the lease on a session this worker still holds"""
+        self.db.query(Session).filter_by(id=session.id, claimed_by=session.claimed_by).update(
+            {'lease_expires': int(time.time()) + lease_seconds()}, synchronize_session=False)
+        self.db.commit()
         self.db.close()
-        if not multiple:
-            return records[0]
-        else:
-            return records
+
+    def sessionsRelease(self, record):
+        """Update a claimed session and give up the claim on it"""
+        record = dict(record, claimed_by=None, lease_expires=None)
+        self.sessionsUpdate(record)
+
+    def sessionsInsert(self, records):
+        return self.insertRecords(Session, records)
 
     def sessionsUpdate(self, records):
         if not isinstance(records, (list,)):
@@ -91,15 +366,18 @@ class ytarchive():
         self.db.commit()
         self.db.close()
 
+    def sessionsUpdateMany(self, changes):
+        self.updateMany(Session, changes)
+
     def sessionsDelete(self, id=None, params=None):
         query = self.db.query(Session)
         if id:
-            results = query.filter_by(id=id).delete()
+            results = query.filter_by(id=id).delete(synchronize_session=False)
         elif params:
             query = self.addParams(query, Session, params)
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
         else:
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
 
         self.db.commit()
         self.db.close()
@@ -130,10 +408,17 @@ class ytarchive():
         self.db.close()
         return results
 
+    def filesGetPage(self, params):
+        return self.getPage(File, params)
+
     def filesGetNewChanged(self, session_id):
         query = self.db.query(File)
         query = query.filter(File.session_id == session_id)
-        query = query.filter(or_(File.state == c.FILE_NEW, File.state == c.FILE_CHANGED))
+        # files only sit in the in-flight states while their session is
+        # claimed, so seeing them here means a previous worker died mid run
+        query = query.filter(File.state.in_([
+            c.FILE_NEW, c.FILE_CHANGED,
+            c.FILE_FETCHING, c.FILE_FETCHED, c.FILE_PROCESSING]))
         results = query.all()
         self.db.close()
         return results
@@ -157,22 +442,7 @@ class ytarchive():
         return results
 
     def filesInsert(self, records):
-        multiple = True
-        if not isinstance(records, (list,)):
-            records = [records]
-            multiple = False
-
-        for index, record in enumerate(records):
-            newFile = File(**record)
-            self.db.add(newFile)
-            self.db.commit()
-            records[index]['id'] = newFile.id
-
-        self.db.close()
-        if not multiple:
-            return records[0]
-        else:
-            return records
+        return self.insertRecords(File, records)
 
     def filesUpdate(self, records):
         if not isinstance(records, (list,)):
@@ -182,15 +452,18 @@ class ytarchive():
         self.db.commit()
         self.db.close()
 
+    def filesUpdateMany(self, changes):
+        self.updateMany(File, changes)
+
     def filesDelete(self, id=None, params=None):
         query = self.db.query(File)
         if id:
-            results = query.filter_by(id=id).delete()
+            results = query.filter_by(id=id).delete(synchronize_session=False)
         elif params:
             query = self.addParams(query, File, params)
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
         else:
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
 
         self.db.commit()
         self.db.close()
@@ -208,6 +481,9 @@ class ytarchive():
         self.db.close()
         return results
 
+    def logsGetPage(self, params):
+        return self.getPage(Log, params)
+
     def logsGetSynced(self, session_id):
         query = self.db.query(Log)
         query = query.filter(Log.session_id == session_id)
@@ -217,23 +493,58 @@ class ytarchive():
         self.db.close()
         return result
 
-    def logsInsert(self, records):
-        multiple = True
-        if not isinstance(records, (list,)):
-            records = [records]
-            multiple = False
+    def logsGetBefore(self, cutoff, limit):
+        """Oldest log rows written before the cutoff timestamp"""
+        query = self.db.query(Log).filter(Log.time < cutoff)
+        results = query.order_by(Log.id.asc()).limit(limit).all()
+        self.db.close()
+        return results
 
-        for index, record in enumerate(records):
-            newLog = Log(**record)
-            self.db.add(newLog)
+    def logsCompact(self, ids, summaries):
+        """Fold {(day, site_id, type, state, severity): count} into the daily
+        summaries and delete the summarized log rows in one transaction so
+        rows are never counted twice or lost
+        """
+        try:
+            for key, count in summaries.items():
+                day, site_id, type, state, severity = key
+                query = self.db.query(LogSummary).filter_by(day=day, site_id=site_id, type=type, state=state, severity=severity)
+                updated = query.update({'count': LogSummary.count + count}, synchronize_session=False)
+                if not updated:
+                    self.db.add(LogSummary(day=day, site_id=site_id, type=type, state=state, severity=severity, count=count))
+            for chunk in self.bindChunks(ids, 1):
+                self.db.query(Log).filter(Log.id.in_(chunk)).delete(synchronize_session=False)
             self.db.commit()
-            records[index]['id'] = newLog.id
-
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+
+    def harvestStateGet(self, site_id):
+        results = self.db.query(HarvestState).filter_by(site_id=site_id).first()
         self.db.close()
-        if not multiple:
-            return records[0]
-        else:
-            return records
+        return results
+
+    def harvestStateSave(self, site_id, created, updated):
+        """Record the watermarks of a completed harvest run for a site"""
+        record = {'created': created, 'updated': updated, 'completed': int(time.time())}
+        try:
+            query = self.db.query(HarvestState).filter_by(site_id=site_id)
+            if not query.update(record, synchronize_session=False):
+                self.db.add(HarvestState(site_id=site_id, **record))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+
+    def logSummariesGetPage(self, params):
+        return self.getPage(LogSummary, params)
+
+    def logsInsert(self, records, return_ids=True):
+        return self.insertRecords(Log, records, return_ids)
 
     def logsUpdate(self, records):
         if not isinstance(records, (list,)):
@@ -246,17 +557,139 @@ class ytarchive():
     def logsDelete(self, id=None, params=None):
         query = self.db.query(Log)
         if id:
-            results = query.filter_by(id=id).delete()
+            results = query.filter_by(id=id).delete(synchronize_session=False)
         elif params:
             query = self.addParams(query, Log, params)
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
         else:
-            results = query.delete()
+            results = query.delete(synchronize_session=False)
 
         self.db.commit()
         self.db.close()
         return results
 
+    def insertRecords(self, Model, records, return_ids=True):
+        """Insert records with multi-row INSERT statements and a single commit
+        per batch, filling in generated ids on the passed records unless
+        return_ids is False
+        """
+        multiple = True
+        if not isinstance(records, (list,)):
+            records = [records]
+            multiple = False
+
+        table = Model.__table__
+        batch_size = insert_batch_size()
+        try:
+            for start in range(0, len(records), batch_size):
+                batch = records[start:start + batch_size]
+                for columns, rows in self.groupByColumns(batch):
+                    for chunk in self.bindChunks(rows, len(columns)):
+                        if 'id' in columns or not return_ids:
+                            self.db.execute(table.insert().values(chunk))
+                        elif self.consecutiveInsertIds():
+                            result = self.db.execute(table.insert().values(chunk))
+                            first_id = self.firstInsertedId(result, len(chunk))
+                            for offset, row in enumerate(chunk):
+                                row['id'] = first_id + offset
+                        else:
+                            # ids may interleave with other writers, so each
+                            # row has to report its own
+                            for row in chunk:
+                                result = self.db.execute(table.insert().values(row))
+                                row['id'] = result.inserted_primary_key[0]
+                self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+
+        if not multiple:
+            return records[0]
+        else:
+            return records
+
+    def updateMany(self, Model, changes):
+        """Apply {id: values} changes to many rows with a single UPDATE, using
+        a CASE expression on id for every column being set. A plain value
+        instead of a dict is shorthand for {'state': value}
+        """
+        if not changes:
+            return
+
+        rows = {}
+        for id, values in changes.items():
+            if not isinstance(values, dict):
+                values = {'state': values}
+            rows[id] = values
+
+        columns = []
+        for values in rows.values():
+            for key in values:
+                if key not in columns:
+                    columns.append(key)
+
+        try:
+            # each id is bound once in the IN list and twice per CASE
+            for ids in self.bindChunks(list(rows.keys()), 1 + 2 * len(columns)):
+                assignments = {}
+                for key in columns:
+                    whens = {id: rows[id][key] for id in ids if key in rows[id]}
+                    if whens:
+                        assignments[key] = case(whens, value=Model.id, else_=getattr(Model, key))
+                query = self.db.query(Model).filter(Model.id.in_(ids))
+                query.update(assignments, synchronize_session=False)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+
+    def consecutiveInsertIds(self):
+        """Whether a multi-row insert is given consecutive auto increment ids.
+        MySQL's interleaved lock mode (innodb_autoinc_lock_mode=2, the 8.0
+        default) can mix in ids from concurrent inserts
+        """
+        global _consecutive_insert_ids
+        if _consecutive_insert_ids is None:
+            if self.db.get_bind().dialect.name == 'sqlite':
+                _consecutive_insert_ids = True
+            else:
+                mode = self.db.execute(text("SELECT @@innodb_autoinc_lock_mode")).scalar()
+                _consecutive_insert_ids = int(mode) != 2
+        return _consecutive_insert_ids
+
+    def firstInsertedId(self, result, count):
+        """MySQL hands out consecutive auto increment ids to a multi-row insert
+        and reports the first one, SQLite reports the last
+        """
+        if self.db.get_bind().dialect.name == 'sqlite':
+            return result.lastrowid - count + 1
+        return result.lastrowid
+
+    def bindChunks(self, items, params_per_item):
+        """Split items so no single statement binds more parameters than the
+        database accepts
+        """
+        limit = max_bind_params()
+        size = len(items)
+        if limit:
+            size = max(1, limit // params_per_item)
+        for start in range(0, len(items), size or 1):
+            yield items[start:start + size]
+
+    def groupByColumns(self, records):
+        """Group records sharing the same keys so each group can be sent as
+        one multi-row VALUES clause
+        """
+        groups = {}
+        for record in records:
+            columns = tuple(sorted(record.keys()))
+            groups.setdefault(columns, []).append(record)
+        return groups.items()
+
     def reset(self):
         self.sessionsDelete()
         self.filesDelete()
@@ -278,7 +711,10 @@ class ytarchive():
                         query = query.filter(getattr(Model, key).in_(values))
                 else:
                     attr = self.getFilterAttr(column, op)
-                    filt = getattr(column, attr)(values)
+                    if attr in ('in_', 'notin_'):
+                        filt = getattr(column, attr)(values)
+                    else:
+                        filt = getattr(column, attr)(values[0])
                     query = query.filter(filt)
             elif 'sort' in key:
                 query = self.addSort(query, Model, params)
@@ -288,6 +724,77 @@ class ytarchive():
                 raise ValueError("Unknown query parameter: " + key)
         return query
 
+    def getPage(self, Model, params):
+        """Return one page of filtered results along with a cursor for the
+        next page, or None on the last page. Pages are read by keyset on the
+        sort column and the primary key rather than by offset, so later pages
+        cost the same as the first.
+        """
+        if "getlist" in dir(params) and len(params.getlist('sort')) > 1:
+            raise ValueError("Only one sort parameter is supported")
+
+        params = params.copy()
+        cursor = params.pop('cursor', None)
+        limit = self.getPageLimit(params.pop('limit', None))
+        sort = params.pop('sort', None)
+        sortkey, direction = self.getPageSort(Model, sort)
+        column = getattr(Model, sortkey)
+
+        query = self.db.query(Model)
+        query = self.addParams(query, Model, params)
+        if cursor:
+            value, id = decode_cursor(cursor)
+            query = query.filter(self.getKeysetFilter(Model, column, direction, value, id))
+
+        if direction == 'asc':
+            query = query.order_by(column.asc(), Model.id.asc())
+        else:
+            query = query.order_by(column.desc(), Model.id.desc())
+
+        results = query.limit(limit + 1).all()
+        self.db.close()
+
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            last = results[-1]
+            next_cursor = encode_cursor(getattr(last, sortkey), last.id)
+        return results, next_cursor
+
+    def getPageLimit(self, value):
+        default, maximum = page_size_limits()
+        if value is None:
+            return default
+        if not self.isInt(value) or int(value) < 1:
+            raise ValueError("Invalid value for limit parameter: " + str(value))
+        return min(int(value), maximum)
+
+    def getPageSort(self, Model, value):
+        if not value:
+            return 'id', 'asc'
+
+        sortkey = value
+        direction = 'asc'
+        parts = value.split(':')
+        if len(parts) == 2 and parts[1] in ('asc', 'desc'):
+            sortkey, direction = parts
+        if not hasattr(Model, sortkey):
+            raise ValueError("Unknown sort parameter: " + sortkey)
+        return sortkey, direction
+
+    def getKeysetFilter(self, Model, column, direction, value, id):
+        """Rows that come after (value, id) in the page order. NULLs sort
+        first ascending and last descending on both MySQL and SQLite
+        """
+        if direction == 'asc':
+            if value is None:
+                return or_(and_(column == None, Model.id > id), column != None)  # noqa: E711
+            return or_(column > value, and_(column == value, Model.id > id))
+        else:
+            if value is None:
+                return and_(column == None, Model.id < id)  # noqa: E711
+            return or_(column < value, and_(column == value, Model.id < id), column == None)  # noqa: E711
+
     def getValues(self, params, key):
         if "getlist" in dir(params):
             values = params.getlist(key)
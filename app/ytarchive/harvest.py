@@ -1,51 +1,80 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
+import sys
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import constants as c
-from db import ytarchive
+from db import ytarchive, settings
 import om_api
 from models import Session, VideoFile, CaptionFile, CuepointFile, DocumentFile
-from log import log
+from log import log, cache_site_id
+import staging
 from args import get_args
 
+# 1514764800 = start of 2018, nothing older is harvested
+HARVEST_START = 1514764800
 
-def get_live_sessions(site, stored_sessions, last_run_time, created_after):
-    """Get sessions from Open.Media API, optionally after the last harvest run
-    time
+# mapped session columns that end up in the archive.org item metadata.
+# archive_id is left out as sync.py writes it back to Open.Media itself
+FINGERPRINT_KEYS = ('archive_collection_id', 'group', 'title', 'description', 'category')
+
+
+def get_live_sessions(site, watermarks, seen):
+    """Get sessions from Open.Media API created or updated after the site
+    watermarks. Sessions are yielded page by page as the API returns them and
+    the highest created and updated times observed are tracked in seen
     """
 
     # start with brand new sessions
-    sessions = om_api.Sessions().list(
+    unprocessed = []
+    sessions = om_api.Sessions().iterate(
         site_id=site['site_id'],
         archived="false",
-        created_after=created_after,
-        video_processed=True)
-    sessions = remove_stored_sessions(sessions, stored_sessions)
+        created_after=max(HARVEST_START, watermarks['created']),
+        video_processed=True,
+        dropped=unprocessed)
+
+    found_new = False
+    for session in remove_stored_sessions(sessions):
+        found_new = True
+        seen['created'] = max(seen['created'], int(session['created']))
+        yield session
+
+    # sessions whose video is still processing must be searched for again,
+    # however long that takes
+    if unprocessed:
+        oldest = min(int(session['created']) for session in unprocessed)
+        seen['created'] = min(seen['created'], oldest - 1)
 
     # no new sessions, check for updated existing ones
-    if len(sessions) <= 0:
-        sessions = om_api.Sessions().list(
+    if not found_new:
+        sessions = om_api.Sessions().iterate(
             site_id=site['site_id'],
             archived="true",
-            updated_after=last_run_time,
+            updated_after=watermarks['updated'],
             video_processed=True)
-    return sessions
+        for session in sessions:
+            seen['updated'] = max(seen['updated'], int(session['updated']))
+            yield session
 
 
-def remove_stored_sessions(sessions, stored_sessions):
-    new_sessions = []
-    for index, session in enumerate(sessions):
-        if int(session['id']) not in stored_sessions:
-            new_sessions.append(session)
-    return new_sessions
+def remove_stored_sessions(sessions):
+    """Drop sessions that have already been stored, checking a page of ids at
+    a time"""
+    for page in chunked(sessions, om_api.page_size()):
+        stored_sessions = get_stored_sessions([int(session['id']) for session in page])
+        for session in page:
+            if int(session['id']) not in stored_sessions:
+                yield session
 
 
-def get_stored_sessions(site):
-    """Get previously stored site sessions to compare against live"""
-    stored_sessions = ytarchive().sessionsGet(id=None, params={'site_id': site['site_id']})
-    if not stored_sessions:
-        stored_sessions = []
-    return stored_sessions
+def get_stored_sessions(ids):
+    """Get the stored state of a page of live sessions to compare against,
+    keyed by id"""
+    return dict_by_id(ytarchive().sessionsGetStates(ids))
 
 
 def get_stored_files(session):
@@ -66,13 +95,9 @@ def dict_by_id(items):
 
 
 def sessions_map_sessions(sessions):
-    """Map Open.Media sessions API entry to session model"""
-    ob_sessions = []
-
+    """Map Open.Media sessions API entries to session models"""
     for session in sessions:
-        ob_sessions.append(Session(session))
-
-    return ob_sessions
+        yield Session(session)
 
 
 def session_map_file_documents(session):
@@ -100,16 +125,21 @@ def get_session_files_metadata(session):
         # youtube video
         files.append(VideoFile(session))
 
-        # youtube captions
-        captions = om_api.Captions().list(session_id=session.id)
+        # youtube captions, the SRT itself is fetched once here and staged
+        # for process.py when the file needs work
+        captions = om_api.Captions().srt(session_id=session.id)
 
         if captions:
-            files.append(CaptionFile(session))
+            caption_file = CaptionFile(session, hashlib.sha1(captions).hexdigest())
+            caption_file.content = captions
+            files.append(caption_file)
 
         # cuepoints
-        cuepoints = om_api.Cuepoints().list(session_id=session.id)
+        cuepoints = om_api.Cuepoints().srt(session_id=session.id)
         if cuepoints:
-            files.append(CuepointFile(session))
+            cuepoint_file = CuepointFile(session)
+            cuepoint_file.content = cuepoints
+            files.append(cuepoint_file)
 
     if session.documents:
         doc_files = session_map_file_documents(session)
@@ -143,23 +173,78 @@ def get_file_state(file, stored_files):
     return state
 
 
-def store_unharvested_file(file):
-    """Insert a new live file into our stored cache"""
-    ytarchive().filesInsert({
+def fingerprint(values):
+    """Stable SHA-1 digest of JSON serialisable values"""
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(file):
+    """Fingerprint of where a live file comes from. Captions, cuepoints and
+    minutes are generated by Open.Media behind a fixed url, so their change
+    marker is included: the caption list, cuepoints_updated and
+    minutes_status respectively"""
+    values = [file.type, file.url]
+    marker = getattr(file, 'marker', None)
+    if marker is not None:
+        values.append(marker)
+    return fingerprint(values)
+
+
+def file_unchanged(file, stored_files):
+    """Determine if a synced file still points at the same source. Video
+    ids are YouTube ids whose content never changes, so a validated video
+    is always unchanged and a new video id arrives as a new file. Files
+    synced before fingerprints existed have none stored and adopt the
+    current one instead of being fetched again"""
+    stored_file = stored_files[file.id]
+    if stored_file.state != c.FILE_SYNCED:
+        return False
+    if file.type == 'video':
+        return bool(stored_file.validated)
+    if stored_file.fingerprint is None:
+        return True
+    return stored_file.fingerprint == file_fingerprint(file)
+
+
+def adopt_file_fingerprint(file, stored_file):
+    """Record the fingerprint of a synced file that predates fingerprints"""
+    if stored_file.fingerprint is None:
+        ytarchive().filesUpdate({'id': file.id, 'fingerprint': file_fingerprint(file)})
+
+
+def stage_file(file):
+    """Hand any content fetched during harvest over to process.py"""
+    if getattr(file, 'content', None):
+        staging.stage(file, file.content)
+
+
+def store_unharvested_files(files):
+    """Insert new live files into our stored cache"""
+    if not files:
+        return
+
+    for file in files:
+        stage_file(file)
+
+    ytarchive().filesInsert([{
         'id': file.id,
         'session_id': file.session_id,
         'url': file.url,
         'type': file.type,
-        'state': c.FILE_NEW})
-    log(file, "New File", c.FILE_NEW)
+        'fingerprint': file_fingerprint(file),
+        'state': c.FILE_NEW} for file in files])
+    for file in files:
+        log(file, "New File", c.FILE_NEW)
 
 
 def update_existing_file(file, state):
     """Update a previously stored file with new metadata from live"""
+    stage_file(file)
     ytarchive().filesUpdate({
         'id': file.id,
         'url': file.url,
         'type': file.type,
+        'fingerprint': file_fingerprint(file),
         'state': state,
         'validated': 0})
     log(file, "Possible change to file", state)
@@ -168,7 +253,8 @@ def update_existing_file(file, state):
 def mark_stored_files_for_removal(stored_files):
     """Mark stored files that have finished processing as removed that are no longer present
     on the live site"""
-    for stored_key, stored_file in enumerate(stored_files):
+    removed_files = []
+    for stored_file in stored_files.values():
         current_state = stored_file.state
         # avoid deleting files that are actively being processed
         condition = ((current_state == c.FILE_NEW or
@@ -176,41 +262,62 @@ def mark_stored_files_for_removal(stored_files):
                      stored_file.validated)
 
         if condition:
-            ytarchive().filesUpdate({
-                'id': stored_file.id,
-                'url': stored_file.url,
-                'type': stored_file.type,
-                'state': c.FILE_REMOVED})
-            log(stored_file, "File removed", c.FILE_REMOVED)
+            removed_files.append(stored_file)
+
+    ytarchive().filesUpdateMany({stored_file.id: c.FILE_REMOVED for stored_file in removed_files})
+    for stored_file in removed_files:
+        log(stored_file, "File removed", c.FILE_REMOVED)
+    return len(removed_files)
+
+
+def prefetch_session_files(sessions):
+    """Fetch file metadata for a page of sessions concurrently, keyed by
+    session id
+    """
+    files = om_api.fetch_all(get_session_files_metadata, sessions)
+    return dict(zip([session.id for session in sessions], files))
 
 
-def store_files(session):
+def store_files(session, files=None):
     """Store and update file metadata from new or changed session
-    We assume that all files that still exist may have been changed and
-    verify this by comparing MD5 during process.py
+    Synced files whose fingerprint is unchanged are left alone, any other
+    file that still exists may have been changed and is verified by
+    comparing MD5 during process.py. Returns the number of files that need
+    work
     """
     stored_files = get_stored_files(session)
     if not stored_files:
-        stored_files = []
+        stored_files = {}
     else:
         stored_files = dict_by_id(stored_files)
 
-    files = get_session_files_metadata(session)
+    if files is None:
+        files = get_session_files_metadata(session)
+    unharvested_files = []
+    changed = 0
 
     for file in files:
         file_state = get_file_state(file, stored_files)
 
         # store new files
         if file_state == c.FILE_UNHARVESTED:
-            store_unharvested_file(file)
+            unharvested_files.append(file)
+        # still present and pointing at the same source, nothing to redo
+        elif file_state == c.FILE_CHANGED and file_unchanged(file, stored_files):
+            adopt_file_fingerprint(file, stored_files.pop(file.id))
         # update new or changed files that are not currently processing
         elif file_state == c.FILE_NEW or file_state == c.FILE_CHANGED:
             update_existing_file(file, file_state)
             del(stored_files[file.id])
+            changed += 1
+
+    store_unharvested_files(unharvested_files)
+    changed += len(unharvested_files)
 
     # we removed new and updated files from the currently stored files
     # list above, any remaining should be marked for deletion on archive.org
-    mark_stored_files_for_removal(stored_files)
+    changed += mark_stored_files_for_removal(stored_files)
+    return changed
 
 
 def session_map_item(site, session, stored_sessions, state):
@@ -241,9 +348,20 @@ def session_map_item(site, session, stored_sessions, state):
     if session.archive_id:
         item['archive_id'] = session.archive_id
 
+    item['fingerprint'] = session_fingerprint(item, session)
     return item
 
 
+def session_fingerprint(item, session):
+    """Fingerprint of the archived session metadata and the video and
+    documents it links to"""
+    documents = session.documents or []
+    return fingerprint({
+        'item': {key: item.get(key) for key in FINGERPRINT_KEYS},
+        'video': [session.video_id, session.video_url],
+        'documents': sorted([str(document.get('id')), str(document.get('url'))] for document in documents)})
+
+
 def session_current_state(session, stored_sessions):
     """Get the current state for a session based on live and stored copy"""
     if session.id not in stored_sessions:
@@ -256,12 +374,15 @@ def session_current_state(session, stored_sessions):
     return current_state
 
 
-def session_next_state(current_state):
+def session_next_state(session, current_state, stored_sessions):
     """Get the next state for a session"""
     if current_state == c.SESSION_NEW:
         next_state = c.SESSION_NEW
+    # unmanaged sessions are stored once, later updates are skipped
+    elif current_state == c.SESSION_UNMANAGED and session.id in stored_sessions:
+        next_state = c.SESSION_SKIPPED
     elif current_state == c.SESSION_UNMANAGED:
-        next_state = c.SESSION_SKIP
+        next_state = c.SESSION_UNMANAGED
     # all sessions that are not new must have been changed as they would
     # otherwise not show up in the api call
     else:
@@ -293,47 +414,101 @@ def session_processing_completed(session, current_state, stored_sessions):
         return False
 
 
-def store_sessions(site, last_run_time, created_after):
+def session_update_due(session, current_state, stored_sessions):
+    """Determine if a stored session changed since the last import and is
+    free to be updated"""
+    # only update if the session has been changed since last import
+    if stored_sessions[session.id].last_updated < session.updated:
+        # only update items that are not currently being processed
+        return session_processing_completed(session, current_state, stored_sessions)
+    return False
+
+
+def session_needs_files(session, stored_sessions):
+    """Determine if store_sessions will store files for a session"""
+    current_state = session_current_state(session, stored_sessions)
+    next_state = session_next_state(session, current_state, stored_sessions)
+
+    if next_state == c.SESSION_NEW:
+        return True
+    elif next_state == c.SESSION_UNMANAGED or next_state == c.SESSION_SKIPPED:
+        return False
+    else:
+        return session_update_due(session, current_state, stored_sessions)
+
+
+def chunked(items, size):
+    """Yield lists of up to size items from any iterable"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def store_sessions(site, watermarks):
     """Loop through all sessions that have changed since last harvest run and
-    update their status in the youtube_archive MySQL database
+    update their status in the youtube_archive MySQL database. Returns counts
+    and the watermarks to record once the run completes
     """
-    # previously harvested sessions
-    stored_sessions = get_stored_sessions(site)
-    stored_sessions = dict_by_id(stored_sessions)
-
     # live sessions that have been updated after the last harvest run
-    sessions = get_live_sessions(site, stored_sessions, last_run_time, created_after)
+    seen = dict(watermarks)
+    sessions = get_live_sessions(site, watermarks, seen)
     sessions = sessions_map_sessions(sessions)
-    results = {'new': [], 'updated': [], 'skipped': []}
-
-    for session in sessions:
-        current_state = session_current_state(session, stored_sessions)
-        next_state = session_next_state(current_state)
-        message = session_state_message(next_state)
-
-        if next_state == c.SESSION_NEW:
-            item = session_map_item(site, session, stored_sessions, c.SESSION_NEW)
-            ytarchive().sessionsInsert(item)
-            results['new'].append(session)
-            store_files(session)
-        # session is new but already has archive information so we avoid it
-        elif next_state == c.SESSION_UNMANAGED:
-            item = session_map_item(site, session, stored_sessions, c.SESSION_UNMANAGED)
-            ytarchive().sessionsInsert(item)
-            results['skipped'].append(session)
-        elif next_state == c.SESSION_SKIPPED:
-            results['skipped'].append(session)
-        # session has been previously imported, check for updates
-        else:
-            # only update if the session has been changed since last import
-            if stored_sessions[session.id].last_updated < session.updated:
-                # only update items that are not currently being processed
-                if session_processing_completed(session, current_state, stored_sessions):
-                    item = session_map_item(site, session, stored_sessions, next_state)
+    results = {'new': 0, 'updated': 0, 'skipped': 0}
+
+    for page in chunked(sessions, om_api.page_size()):
+        # previously harvested copies of this page only
+        stored_sessions = get_stored_sessions([session.id for session in page])
+
+        # Open.Media lookups for the whole page run concurrently up front,
+        # database writes below stay in session order
+        page_files = prefetch_session_files([session for session in page if session_needs_files(session, stored_sessions)])
+
+        for session in page:
+            cache_site_id(session)
+            current_state = session_current_state(session, stored_sessions)
+            next_state = session_next_state(session, current_state, stored_sessions)
+            message = session_state_message(next_state)
+
+            if next_state == c.SESSION_NEW:
+                item = session_map_item(site, session, stored_sessions, c.SESSION_NEW)
+                ytarchive().sessionsInsert(item)
+                results['new'] += 1
+                store_files(session, page_files[session.id])
+            # session is new but already has archive information so we avoid it
+            elif next_state == c.SESSION_UNMANAGED:
+                item = session_map_item(site, session, stored_sessions, c.SESSION_UNMANAGED)
+                ytarchive().sessionsInsert(item)
+                results['skipped'] += 1
+            elif next_state == c.SESSION_SKIPPED:
+                results['skipped'] += 1
+            # session has been previously imported, check for updates
+            elif session_update_due(session, current_state, stored_sessions):
+                item = session_map_item(site, session, stored_sessions, next_state)
+                changed_files = store_files(session, page_files[session.id])
+                if changed_files or stored_sessions[session.id].fingerprint != item['fingerprint']:
+                    # archived sessions whose files are all current only
+                    # need their metadata sent, skipping process.py
+                    if not changed_files and current_state == c.SESSION_SYNCED:
+                        item['state'] = next_state = c.SESSION_METADATA
+                        message = "Session metadata changed"
+                        # files are untouched, so their validation still stands
+                        del item['validated']
                     ytarchive().sessionsUpdate(item)
-                    results['updated'].append(session)
-                    store_files(session)
-        log(session, message, next_state)
+                    results['updated'] += 1
+                else:
+                    # an Open.Media edit that changes nothing we archive, only
+                    # note that this version has been seen
+                    ytarchive().sessionsUpdate({'id': session.id, 'last_updated': session.updated})
+                    next_state = current_state
+                    message = "Session unchanged"
+                    results['skipped'] += 1
+            log(session, message, next_state)
+    results['watermarks'] = seen
     return results
 
 
@@ -341,9 +516,20 @@ def last_run_time(site):
     """Get the unix timestamp from the last harvest run for a given site"""
     results = ytarchive().logsGet(id=None, params={'site_id': site['site_id'], 'type': 'harvest_run', 'state': 'harvesting', 'sort': 'time:desc', 'limit': 1})
     if results:
-        return results[0].time
-    else:
-        return time.time()
+        return int(results[0].time)
+    return None
+
+
+def get_watermarks(site):
+    """Get the created and updated high-water marks of the last completed
+    harvest for a site. Sites harvested before harvest_state existed fall
+    back to the last harvest_run log, and sites never harvested start from
+    the beginning rather than skipping anything
+    """
+    state = ytarchive().harvestStateGet(site['site_id'])
+    if state:
+        return {'created': state.created, 'updated': state.updated}
+    return {'created': HARVEST_START, 'updated': last_run_time(site) or HARVEST_START}
 
 
 def log_harvest_run_start(site):
@@ -372,34 +558,75 @@ def log_harvest_run_end(site, items_added, items_updated, items_deleted):
         'state': 'harvested'})
 
 
+def log_harvest_run_failed(site, error):
+    """Record a site harvest_run that stopped on an error"""
+    ytarchive().logsInsert({
+        'time': time.time(),
+        'site_id': site['site_id'],
+        'type': 'harvest_run',
+        'severity': c.LOG_ERROR,
+        'message': "Harvest run failed: " + str(error),
+        'state': 'failed'})
+
+
+def configured_site_ids():
+    """Site ids to harvest from the [harvest] site_ids setting, None for every
+    site with an archive.org collection"""
+    site_ids = settings().get('harvest', 'site_ids', fallback='382,400').strip()
+    if site_ids == 'all':
+        return None
+    return [site_id.strip() for site_id in site_ids.split(',') if site_id.strip()]
+
+
 def get_sites(args):
     final_sites = []
-    site_ids = ['382', '400']
+    site_ids = configured_site_ids()
     if args.site:
         site_ids = [str(args.site)]
 
     sites = om_api.Sites().list(has_archive_collection=True)
 
     for site in sites:
-        if site['site_id'] in site_ids:
+        if site_ids is None or str(site['site_id']) in site_ids:
             final_sites.append(site)
 
     return final_sites
 
 
+def harvest_site(site):
+    """Harvest one site. Errors are logged against the site and not raised so
+    they never hold up the other sites"""
+    try:
+        watermarks = get_watermarks(site)
+        log_harvest_run_start(site)
+        results = store_sessions(site, watermarks)
+        # only a completed run moves the watermarks, an interrupted one is
+        # picked up again from the previous marks
+        ytarchive().harvestStateSave(site['site_id'], results['watermarks']['created'], results['watermarks']['updated'])
+        log_harvest_run_end(site, results["new"], results["updated"], 0)
+        return True
+    except Exception as e:
+        traceback.print_exc()
+        try:
+            log_harvest_run_failed(site, e)
+        except Exception:
+            traceback.print_exc()
+        return False
+
+
 def harvest():
     """Grab all sites from Open.Media API that have a defined archive.org
     collection then store new and updated session information
     """
     args = get_args()
     sites = get_sites(args)
-    # 1514764800 = start of 2018
-    created_after = 1514764800
-    for site in sites:
-        the_last_run_time = last_run_time(site)
-        log_harvest_run_start(site)
-        results = store_sessions(site, the_last_run_time, created_after)
-        log_harvest_run_end(site, len(results["new"]), len(results["updated"]), 0)
+    # requests to Open.Media are capped process wide, see om_api.max_in_flight
+    site_concurrency = settings().getint('harvest', 'site_concurrency', fallback=4)
+    with ThreadPoolExecutor(max_workers=max(1, min(site_concurrency, len(sites)))) as executor:
+        completed = list(executor.map(harvest_site, sites))
+    if not all(completed):
+        sys.exit(1)
 
 
-harvest()
+if __name__ == '__main__':
+    harvest()
@@ -1,10 +1,175 @@
 #!/usr/bin/env python3
 
+import atexit
+import json
+import os
+import queue
+import signal
+import sys
+import threading
 import time
-from db import ytarchive
+from sqlalchemy.exc import OperationalError, InterfaceError
+from db import ytarchive, settings, insert_batch_size
+from sqlalchemy_declarative import Log
 import constants as c
 debug_mode = True
 
+_writer = None
+_writer_lock = threading.Lock()
+_site_ids = {}
+
+
+class LogWriter():
+    """Buffers log rows in memory and inserts them in batches from a
+    background thread. Whatever is left is written when the process exits,
+    and rows the database refuses at that point are spilled to disk as
+    NDJSON so none are lost.
+    """
+
+    def __init__(self):
+        config = settings()
+        self.batch_size = config.getint('logs', 'batch_size', fallback=200)
+        self.flush_interval = config.getfloat('logs', 'flush_interval', fallback=2.0)
+        self.spill_path = config.get('logs', 'spill_path', fallback='/transfers/log_spill.ndjson')
+        self.rejected_path = config.get('logs', 'rejected_path', fallback='/transfers/log_rejected.ndjson')
+        self.queue = queue.Queue()
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.replay()
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def replay(self):
+        """Queue rows spilled by an earlier process. The spill file is renamed
+        first so concurrent workers never replay the same rows twice
+        """
+        if not os.path.exists(self.spill_path):
+            return
+        claimed_path = self.spill_path + "." + str(os.getpid())
+        try:
+            os.rename(self.spill_path, claimed_path)
+        except OSError:
+            return
+        with open(claimed_path) as f:
+            for line in f:
+                if line.strip():
+                    self.queue.put(fit_columns(json.loads(line)))
+        os.remove(claimed_path)
+
+    def put(self, data):
+        self.queue.put(fit_columns(data))
+        if self.queue.qsize() >= self.batch_size:
+            self.wake.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.write()
+
+    def write(self):
+        """Insert everything queued so far, keeping rows that could not be
+        written for the next attempt. Returns False if any rows remain
+        """
+        with self.lock:
+            while True:
+                try:
+                    self.pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # each insert call commits as a whole, so a failure never leaves
+            # part of a chunk written that would be repeated on retry
+            chunk_size = min(self.batch_size, insert_batch_size())
+            while self.pending:
+                chunk = self.pending[:chunk_size]
+                try:
+                    ytarchive().logsInsert(chunk, return_ids=False)
+                except (OperationalError, InterfaceError) as e:
+                    # database unreachable, try again on the next pass
+                    print("Failed to write " + str(len(self.pending)) + " log rows: " + str(e), file=sys.stderr)
+                    return False
+                except Exception as e:
+                    # rows the database rejects would block the queue forever,
+                    # and would only be rejected again if replayed
+                    print("Database rejected " + str(len(chunk)) + " log rows: " + str(e), file=sys.stderr)
+                    self.spill(chunk, self.rejected_path)
+                del self.pending[:len(chunk)]
+            return True
+
+    def spill(self, rows, spill_path=None):
+        """Append unwritten rows to the spill file for later replay, or to
+        another file such as the never replayed rejected rows file"""
+        spill_path = spill_path or self.spill_path
+        directory = os.path.dirname(spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(spill_path, 'a') as f:
+            for data in rows:
+                f.write(json.dumps(data) + "\n")
+        print("Spilled " + str(len(rows)) + " log rows to " + spill_path, file=sys.stderr)
+
+    def close(self):
+        """Stop the background thread and flush the remaining rows"""
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join(self.flush_interval + 5)
+        if not self.write():
+            with self.lock:
+                self.spill(self.pending)
+                self.pending = []
+
+
+def fit_columns(data):
+    """Truncate string values to their column lengths so a long message
+    never gets a whole batch of log rows rejected"""
+    for key, value in data.items():
+        if isinstance(value, str) and key in Log.__table__.columns:
+            length = getattr(Log.__table__.columns[key].type, 'length', None)
+            if length and len(value) > length:
+                data[key] = value[:length]
+    return data
+
+
+def handle_sigterm(signum, frame):
+    """Exit normally on SIGTERM so buffered logs are flushed by atexit"""
+    sys.exit(128 + signum)
+
+
+def get_writer():
+    """Start the process wide log writer on first use"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter()
+                atexit.register(_writer.close)
+                in_main_thread = threading.current_thread() is threading.main_thread()
+                if in_main_thread and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                    signal.signal(signal.SIGTERM, handle_sigterm)
+    return _writer
+
+
+def flush():
+    """Write all buffered logs now"""
+    if _writer is not None:
+        return _writer.write()
+    return True
+
+
+def cache_site_id(session):
+    """Remember which site a session belongs to so file logs skip the lookup"""
+    _site_ids[session.id] = session.site_id
+
+
+def session_site_id(session_id):
+    if session_id not in _site_ids:
+        session = ytarchive().sessionsGet(id=session_id)
+        _site_ids[session_id] = session.site_id
+    return _site_ids[session_id]
+
 
 def log(item, message, state=None, severity=c.LOG_STATUS):
     if not state:
@@ -14,13 +179,13 @@ def log(item, message, state=None, severity=c.LOG_STATUS):
         session_id = item.session_id
         file_id = item.id
         type = 'file'
-        session = ytarchive().sessionsGet(id=item.session_id)
-        site_id = session.site_id
+        site_id = session_site_id(item.session_id)
     else:
         session_id = item.id
         file_id = None
         type = 'session'
         site_id = item.site_id
+        cache_site_id(item)
 
     data = {
         'session_id': session_id,
@@ -32,7 +197,7 @@ def log(item, message, state=None, severity=c.LOG_STATUS):
         'type': type,
         'site_id': site_id}
 
-    ytarchive().logsInsert(data)
+    get_writer().put(data)
     if debug_mode:
         print(prepare_console_message(data))
 
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+from migrations import migrate
+
+
+def run_migrations():
+    """Bring the youtube_archive schema up to date"""
+    applied = migrate()
+    if not applied:
+        print("Schema is up to date")
+    for migration in applied:
+        print("Applied migration " + str(migration['version']) + ": " + migration['description'])
+
+
+run_migrations()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import time
+from sqlalchemy import select, text
+from db import get_engine
+from sqlalchemy_declarative import SchemaMigration, LogSummary, HarvestState
+
+# Versioned schema changes applied in order to existing deployments. Every
+# change here must also be made to db/youtube_archive_schema.sql and the
+# models in sqlalchemy_declarative.py so new installs start out current.
+# A step is either a SQL string or a callable taking a connection.
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': "Indexes for work queue, file and log lookups",
+        'steps': [
+            "CREATE INDEX ix_sessions_state_last_updated ON sessions (state, last_updated)",
+            "CREATE INDEX ix_sessions_site_id_state_last_updated ON sessions (site_id, state, last_updated)",
+            "CREATE INDEX ix_sessions_state_validated_last_updated ON sessions (state, validated, last_updated)",
+            "CREATE INDEX ix_files_session_id_state ON files (session_id, state)",
+            "CREATE INDEX ix_logs_site_id_type_state_time ON logs (site_id, type, state, time)",
+            "CREATE INDEX ix_logs_session_id_state ON logs (session_id, state)",
+        ]},
+    {
+        'version': 2,
+        'description': "Session claims and leases for concurrent workers",
+        'steps': [
+            "ALTER TABLE sessions ADD COLUMN claimed_by varchar(64) DEFAULT NULL",
+            "ALTER TABLE sessions ADD COLUMN lease_expires int(11) DEFAULT NULL",
+            "CREATE INDEX ix_sessions_claimed_by ON sessions (claimed_by)",
+        ]},
+    {
+        'version': 3,
+        'description': "Daily log summaries kept after old logs are rotated out",
+        'steps': [
+            lambda connection: LogSummary.__table__.create(connection, checkfirst=True),
+        ]},
+    {
+        'version': 4,
+        'description': "Per-site harvest watermarks",
+        'steps': [
+            lambda connection: HarvestState.__table__.create(connection, checkfirst=True),
+        ]},
+    {
+        'version': 5,
+        'description': "Session and file fingerprints",
+        'steps': [
+            "ALTER TABLE sessions ADD COLUMN fingerprint varchar(40) DEFAULT NULL",
+            "ALTER TABLE files ADD COLUMN fingerprint varchar(40) DEFAULT NULL",
+        ]},
+    {
+        'version': 6,
+        'description': "File SHA-1 digests",
+        'steps': [
+            "ALTER TABLE files ADD COLUMN sha1 varchar(40) DEFAULT NULL",
+        ]},
+]
+
+
+def applied_versions(connection):
+    """Versions already recorded in the schema_migrations table"""
+    SchemaMigration.__table__.create(connection, checkfirst=True)
+    rows = connection.execute(select([SchemaMigration.version]))
+    return set(row[0] for row in rows)
+
+
+def stamp(connection):
+    """Record every migration as applied for a schema created from the
+    current models"""
+    applied = applied_versions(connection)
+    for migration in MIGRATIONS:
+        if migration['version'] not in applied:
+            record_migration(connection, migration)
+
+
+def pending_migrations(connection):
+    """Migrations that have not been applied yet, oldest first"""
+    applied = applied_versions(connection)
+    return [migration for migration in MIGRATIONS if migration['version'] not in applied]
+
+
+def record_migration(connection, migration):
+    connection.execute(SchemaMigration.__table__.insert().values(
+        version=migration['version'],
+        description=migration['description'],
+        applied=int(time.time())))
+
+
+def apply_migration(connection, migration):
+    """Run each step of a migration then record it as applied"""
+    for step in migration['steps']:
+        if callable(step):
+            step(connection)
+        else:
+            connection.execute(text(step))
+    record_migration(connection, migration)
+
+
+def migrate():
+    """Apply all pending migrations and return the ones that ran. SQLite
+    databases are migrated automatically when first opened, so for them
+    this only reports that the schema is current.
+    """
+    applied = []
+    with get_engine().connect() as connection:
+        for migration in pending_migrations(connection):
+            apply_migration(connection, migration)
+            applied.append(migration)
+    return applied
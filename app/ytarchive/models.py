@@ -30,7 +30,7 @@ class VideoFile():
 
 
 class CaptionFile():
-    def __init__(self, session):
+    def __init__(self, session, captions_hash=None):
         api_url = Base().settings()['om_api']['url']
         captions_id = str(session.id) + "_captions"
         captions_url = api_url + "/session/"
@@ -41,6 +41,7 @@ class CaptionFile():
         self.id = captions_id
         self.url = captions_url
         self.type = 'captions'
+        self.marker = captions_hash
 
 
 class CuepointFile():
@@ -55,6 +56,7 @@ class CuepointFile():
         self.id = cuepoints_id
         self.url = cuepoints_url
         self.type = 'cuepoints'
+        self.marker = session.cuepoints_updated
 
 
 class DocumentFile():
@@ -63,3 +65,5 @@ class DocumentFile():
         self.id = "doc-" + document['type'].lower() + "-" + str(document['id'])
         self.url = document['url']
         self.type = document['type']
+        # minutes are rendered by Open.Media behind a fixed url
+        self.marker = session.minutes_status if self.type.lower() == 'minutes' else None
@@ -1,20 +1,366 @@
 #!/usr/bin/env python3
 
+import base64
 import configparser
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_config = None
+_processed_cache = None
+_processed_cache_lock = threading.Lock()
+_http = None
+_http_lock = threading.Lock()
+_response_cache = None
+_response_cache_lock = threading.Lock()
+_request_slots = None
+
+
+def get_config():
+    """Load config.ini once per process"""
+    global _config
+    if _config is None:
+        config_path = path.join(path.abspath(path.dirname(__file__)), 'config.ini')
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _config = config
+    return _config
+
+
+def concurrency():
+    """Maximum number of Open.Media API requests a fan-out runs at once"""
+    return get_config().getint('om_api', 'concurrency', fallback=8)
+
+
+def max_in_flight():
+    """Maximum number of Open.Media requests in flight across the whole
+    process, however many sites and fan-outs are running"""
+    return get_config().getint('om_api', 'max_in_flight', fallback=16)
+
+
+def request_slots():
+    """Process wide semaphore bounding concurrent Open.Media requests"""
+    global _request_slots
+    if _request_slots is None:
+        with _http_lock:
+            if _request_slots is None:
+                _request_slots = threading.BoundedSemaphore(max_in_flight())
+    return _request_slots
+
+
+def page_size():
+    """Number of sessions handled together per page"""
+    return get_config().getint('om_api', 'page_size', fallback=50)
+
+
+def fetch_all(fn, items):
+    """Call fn for every item on a bounded thread pool, returning results in
+    the same order as items
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(concurrency(), len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def timeout():
+    """Connect and read timeouts in seconds for Open.Media requests"""
+    config = get_config()
+    return (config.getfloat('om_api', 'connect_timeout', fallback=5.0),
+            config.getfloat('om_api', 'read_timeout', fallback=60.0))
+
+
+def get_http():
+    """Create the process wide keep-alive HTTP session on first use. Idempotent
+    requests are retried with backoff on 429 and 5xx responses
+    """
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                config = get_config()
+                retry = Retry(
+                    total=config.getint('om_api', 'retries', fallback=3),
+                    backoff_factor=config.getfloat('om_api', 'backoff_factor', fallback=0.5),
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    raise_on_status=False)
+                # one pooled connection per request allowed in flight
+                adapter = HTTPAdapter(pool_maxsize=max(max_in_flight(), 10), max_retries=retry)
+                http = requests.Session()
+                http.mount('http://', adapter)
+                http.mount('https://', adapter)
+                http.headers.update({'Accept-Encoding': 'gzip, deflate'})
+                _http = http
+    return _http
+
+
+class ProcessedCache():
+    """Append-only record of session videos Open.Media has reported as
+    processed. A processed video never goes back to unprocessed, so anything
+    recorded here is not asked about again. Entries are keyed on session id
+    and video url so a replaced video is checked afresh.
+    """
+
+    def __init__(self, cache_path):
+        self.path = cache_path
+        self.keys = set()
+        self.lock = threading.Lock()
+        if path.exists(self.path):
+            with open(self.path) as f:
+                self.keys = set(line.strip() for line in f if line.strip())
+
+    @staticmethod
+    def key(session):
+        return str(session['id']) + ":" + session['video_url']
+
+    def __contains__(self, session):
+        return self.key(session) in self.keys
+
+    def add(self, sessions):
+        keys = [self.key(session) for session in sessions if session not in self]
+        if not keys:
+            return
+        with self.lock:
+            self.keys.update(keys)
+            try:
+                directory = path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write("".join(key + "\n" for key in keys))
+            except OSError as e:
+                # the cache only saves requests, losing it is harmless
+                print("Could not write processed cache " + self.path + ": " + str(e), file=sys.stderr)
+
+
+def get_processed_cache():
+    """Load the processed video cache once per process"""
+    global _processed_cache
+    if _processed_cache is None:
+        with _processed_cache_lock:
+            if _processed_cache is None:
+                cache_path = get_config().get('om_api', 'processed_cache', fallback='/transfers/om_processed_cache')
+                _processed_cache = ProcessedCache(cache_path)
+    return _processed_cache
+
+
+def processed_statuses(sessions):
+    """Resolve the youtube processed status for sessions with a video_url,
+    only asking Open.Media about videos not already known to be processed
+    """
+    cache = get_processed_cache()
+    unknown = [session for session in sessions if session not in cache]
+    session_video = SessionVideo()
+    statuses = fetch_all(lambda session: session_video.processedStatus(session['id']), unknown)
+    cache.add([session for session, processed in zip(unknown, statuses) if processed])
+
+    resolved = {session['id']: processed for session, processed in zip(unknown, statuses)}
+    return [resolved.get(session['id'], True) for session in sessions]
+
+
+class ResponseCache():
+    """On-disk cache of Open.Media JSON responses. Entries are reused without
+    a request while younger than their endpoint TTL and revalidated with
+    If-None-Match/If-Modified-Since after that. The least recently used
+    entries are evicted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total = 0
+
+    @staticmethod
+    def key(url, params=None):
+        if params:
+            url += "?" + "&".join(str(k) + "=" + str(v) for k, v in sorted(params.items()))
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return path.join(self.directory, key + ".json")
+
+    def index(self):
+        """Sizes and access times of cached entries, read from disk once"""
+        if self.entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.entries = {}
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    stat = os.stat(path.join(self.directory, name))
+                    self.entries[name[:-5]] = [stat.st_size, stat.st_mtime]
+            self.total = sum(size for size, used in self.entries.values())
+        return self.entries
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.touch(key)
+        return entry
+
+    def touch(self, key):
+        now = time.time()
+        with self.lock:
+            if key in self.index():
+                self.entries[key][1] = now
+        try:
+            os.utime(self.path(key), (now, now))
+        except OSError:
+            pass
+
+    def store(self, key, entry):
+        data = json.dumps(entry)
+        tmp_path = self.path(key) + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        with self.lock:
+            entries = self.index()
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path(key))
+            except OSError as e:
+                # the cache only saves requests, losing an entry is harmless
+                print("Could not write response cache " + self.directory + ": " + str(e), file=sys.stderr)
+                return
+            if key in entries:
+                self.total -= entries[key][0]
+            entries[key] = [len(data), time.time()]
+            self.total += len(data)
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes"""
+        if self.total <= self.max_bytes:
+            return
+        for key, (size, used) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            del self.entries[key]
+            self.total -= size
+            if self.total <= self.max_bytes:
+                break
+
+
+def get_response_cache():
+    """Open the response cache once per process, None when disabled"""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                config = get_config()
+                directory = config.get('om_api', 'cache_dir', fallback='/transfers/om_api_cache')
+                max_mb = config.getint('om_api', 'cache_max_mb', fallback=200)
+                _response_cache = ResponseCache(directory, max_mb * 1024 * 1024) if max_mb > 0 else False
+    return _response_cache or None
+
+
+# seconds a cached response is used without revalidating, by endpoint
+CACHE_TTLS = {'sites': 3600, 'captions': 0, 'cuepoints': 0}
+
+
+def cache_ttl(endpoint):
+    return get_config().getint('om_api', 'cache_ttl_' + endpoint, fallback=CACHE_TTLS.get(endpoint, 0))
 
 
 class OmApi():
 
     def __init__(self):
-        config_path = path.join(path.abspath(path.dirname(__file__)), 'config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_path)
+        config = get_config()
 
         self.api_url = config['om_api']['url']
         self.api_key = config['om_api']['key']
 
+    def httpGet(self, url, params=None):
+        with request_slots():
+            return get_http().get(url, params=params, timeout=timeout())
+
+    def httpPost(self, url, data=None):
+        with request_slots():
+            return get_http().post(url, data=data, timeout=timeout())
+
+    @staticmethod
+    def responseContent(response):
+        """The raw body of a file endpoint response, None when Open.Media
+        has nothing there"""
+        if response.status_code == 404 or response.status_code == 403:
+            return None
+        if not response.content or response.content == b"false":
+            return None
+        return response.content
+
+    def responseBody(self, response, content):
+        """Decode a response. Errors that outlived the retries are raised so
+        an error page is never mistaken for content"""
+        if not response.ok and response.status_code not in (403, 404):
+            response.raise_for_status()
+        return self.responseContent(response) if content else response.json()
+
+    def contentGet(self, url, endpoint):
+        """GET the raw body of a file endpoint through the response cache,
+        None when Open.Media has nothing there"""
+        return self.cachedGet(url, endpoint, content=True)
+
+    def cachedGet(self, url, endpoint, params=None, content=False):
+        """GET a JSON endpoint through the response cache, or the raw body
+        of a file endpoint when content is set"""
+        cache = get_response_cache()
+        if cache is None:
+            return self.responseBody(self.httpGet(url, params), content)
+
+        key = cache.key(url, params)
+        entry = cache.load(key)
+        if entry and time.time() - entry['fetched'] < cache_ttl(endpoint):
+            return self.cachedBody(entry, content)
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        with request_slots():
+            response = get_http().get(url, params=params, headers=headers, timeout=timeout())
+
+        if entry and response.status_code == 304:
+            entry['fetched'] = time.time()
+            cache.store(key, entry)
+            return self.cachedBody(entry, content)
+
+        body = self.responseBody(response, content)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.ok and (etag or last_modified or cache_ttl(endpoint) > 0):
+            if content and body is not None:
+                # the cache is JSON, so binary bodies are kept as base64
+                stored = base64.b64encode(body).decode('ascii')
+            else:
+                stored = body
+            cache.store(key, {
+                'fetched': time.time(),
+                'etag': etag,
+                'last_modified': last_modified,
+                'body': stored})
+        return body
+
+    @staticmethod
+    def cachedBody(entry, content):
+        if content and entry['body'] is not None:
+            return base64.b64decode(entry['body'])
+        return entry['body']
+
 
 class Sites(OmApi):
 
@@ -23,8 +369,7 @@ class Sites(OmApi):
         self.endpoint = self.api_url + "/sites?key=" + self.api_key + "&limit=200"
 
     def list(self, has_archive_collection=None):
-        sites_data = requests.get(self.endpoint)
-        sites = sites_data.json()
+        sites = self.cachedGet(self.endpoint, 'sites')
         results = []
 
         if has_archive_collection is not None:
@@ -47,11 +392,18 @@ class Sessions(OmApi):
     def get(self, session_id):
         session_url = self.api_url + "/sessions/" + str(session_id)
 
-        session_data = requests.get(session_url)
+        session_data = self.httpGet(session_url)
         session = session_data.json()
         return session
 
     def list(self, site_id=None, updated_after=None, video_processed=None, archived=None, created_after=None):
+        return list(self.iterate(site_id, updated_after, video_processed, archived, created_after))
+
+    def iterate(self, site_id=None, updated_after=None, video_processed=None, archived=None, created_after=None, dropped=None):
+        """Walk the sessions endpoint a page at a time, yielding sessions as
+        each page arrives. Sessions left out by video_processed are added to
+        the dropped list when one is given
+        """
         # craft endpoint
         sessions_url = self.api_url
         if not site_id:
@@ -68,27 +420,56 @@ class Sessions(OmApi):
         if created_after:
             filters['createdAfter'] = str(created_after)
 
-        sessions_data = requests.get(sessions_url, params=filters)
-        sessions = sessions_data.json()
-        results = []
+        limit = page_size()
+        offset = 0
+        previous_ids = None
+        seen_ids = set()
+        while True:
+            params = dict(filters, limit=limit, offset=offset)
+            sessions = self.httpGet(sessions_url, params=params).json()["results"]
+            ids = [session['id'] for session in sessions]
+            if not sessions:
+                break
+            # an endpoint that ignores offset hands back the same page again,
+            # read everything in one request rather than stop short
+            if ids == previous_ids:
+                print("Warning: " + sessions_url + " ignores offset, fetching all sessions unpaged", file=sys.stderr)
+                sessions = self.httpGet(sessions_url, params=filters).json()["results"]
+                sessions = [session for session in sessions if session['id'] not in seen_ids]
+                for session in self.filterProcessed(sessions, video_processed, dropped):
+                    yield session
+                break
+            for session in self.filterProcessed(sessions, video_processed, dropped):
+                yield session
+            # a short page is not the end, Open.Media may cap the page size
+            # below limit, only an empty page is
+            previous_ids = ids
+            seen_ids.update(ids)
+            offset += len(sessions)
+
+    def filterProcessed(self, sessions, video_processed=None, dropped=None):
+        """Keep sessions whose youtube processed status matches
+        video_processed, or all sessions if it is None. Any other session is
+        added to dropped when it is given
+        """
+        if video_processed is None:
+            return sessions
 
-        if video_processed is not None:
-            for session in sessions["results"]:
-                if "video_url" in session:
-                    sessionVideo = SessionVideo()
-                    processed = sessionVideo.processedStatus(session["id"])
-                    if processed and video_processed:
-                        results.append(session)
-                    elif not processed and not video_processed:
-                        results.append(session)
-        else:
-            results = sessions["results"]
+        results = []
+        video_sessions = [session for session in sessions if "video_url" in session]
+        for session, processed in zip(video_sessions, processed_statuses(video_sessions)):
+            if processed and video_processed:
+                results.append(session)
+            elif not processed and not video_processed:
+                results.append(session)
+        if dropped is not None:
+            dropped.extend(session for session in sessions if session not in results)
         return results
 
     def updateArchiveId(self, session_id, archive_id):
         sessions_url = self.api_url + "/sessions/" + str(session_id)
         sessions_url += "?key=" + self.api_key
-        requests.post(sessions_url, data={'archive_id': archive_id})
+        self.httpPost(sessions_url, data={'archive_id': archive_id})
 
 
 class SessionVideo(OmApi):
@@ -98,7 +479,7 @@ class SessionVideo(OmApi):
 
     def processedStatus(self, session_id):
         processed_url = self.api_url + "/session/" + str(session_id) + "/youtube-processed"
-        processed_data = requests.get(processed_url)
+        processed_data = self.httpGet(processed_url)
         processed = processed_data.json()
         processed = processed["results"]["processed"]
 
@@ -117,11 +498,14 @@ class Captions(OmApi):
         else:
             url += "/session/" + str(session_id) + "/captions"
 
-        json_data = requests.get(url)
-        data = json_data.json()
+        data = self.cachedGet(url, 'captions')
 
         return data['results']
 
+    def srt(self, session_id):
+        """The session captions as SRT, None if there are none"""
+        return self.contentGet(self.api_url + "/session/" + str(session_id) + "/captions-srt", 'captions')
+
 
 class Cuepoints(OmApi):
     def __init__(self):
@@ -135,7 +519,10 @@ class Cuepoints(OmApi):
         else:
             url += "/session/" + str(session_id) + "/cuepoints"
 
-        json_data = requests.get(url)
-        data = json_data.json()
+        data = self.cachedGet(url, 'cuepoints')
 
         return data['results']
+
+    def srt(self, session_id):
+        """The session cuepoints as SRT, None if there are none"""
+        return self.contentGet(self.api_url + "/session/" + str(session_id) + "/cuepoints-srt", 'cuepoints')
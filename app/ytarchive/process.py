@@ -5,11 +5,26 @@ import requests
 import os
 import errno
 import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call
-from db import ytarchive
+from urllib.parse import urlparse
+from db import ytarchive, settings
 from log import log
+import staging
 from args import get_args
 
+# bytes read or written per step when downloading and hashing
+CHUNK_SIZE = 1024 * 1024
+# tries per download, each one resuming where the last stopped
+DOWNLOAD_ATTEMPTS = 3
+# connect and read timeouts, a stalled transfer is retried from its .part
+DOWNLOAD_TIMEOUT = (10, 300)
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
 
 def create_directory(filepath):
     """Create a directory if it does not exist"""
@@ -21,23 +36,111 @@ def create_directory(filepath):
                 raise
 
 
+def part_source(part_path):
+    """The url and validator a .part file was downloaded from, if recorded"""
+    try:
+        with open(part_path + ".source") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_part(part_path):
+    for stale_path in (part_path, part_path + ".source"):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+
+def download_part(url, part_path):
+    """Stream url into part_path, continuing from whatever an earlier attempt
+    left there. A part is only resumed if it came from the same url and the
+    server confirms with If-Range that the file has not changed since,
+    otherwise it is thrown away. Returns the md5 and sha1 digests of the
+    whole file, or False if there is no file
+    """
+    source = part_source(part_path)
+    if os.path.exists(part_path) and (not source or source['url'] != url or not source['validator']):
+        remove_part(part_path)
+
+    hash_md5 = hashlib.md5()
+    hash_sha1 = hashlib.sha1()
+    offset = 0
+    headers = {}
+    if os.path.exists(part_path):
+        # digests have to cover the bytes already on disk too
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                hash_md5.update(chunk)
+                hash_sha1.update(chunk)
+                offset += len(chunk)
+        headers = {'Range': 'bytes=' + str(offset) + '-', 'If-Range': source['validator']}
+
+    with requests.get(url, allow_redirects=True, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 404 or r.status_code == 403:
+            return False
+        # the partial file no longer fits what the server has, start over
+        if r.status_code == 416:
+            remove_part(part_path)
+            return download_part(url, part_path)
+
+        mode = 'ab'
+        if r.status_code != 206:
+            # a new or changed file, the server is sending all of it
+            hash_md5 = hashlib.md5()
+            hash_sha1 = hashlib.sha1()
+            mode = 'wb'
+            with open(part_path + ".source", 'w') as f:
+                json.dump({'url': url, 'validator': r.headers.get('ETag') or r.headers.get('Last-Modified')}, f)
+        with open(part_path, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                hash_md5.update(chunk)
+                hash_sha1.update(chunk)
+
+    return hash_md5.hexdigest(), hash_sha1.hexdigest()
+
+
 def download_file(url, filepath):
-    """Download a file and store to the provided filepath"""
-    r = requests.get(url, allow_redirects=True)
-    if r.status_code == 404 or r.status_code == 403:
-        return False
-    elif r.content == "false":
+    """Stream a file to the provided filepath, hashing it as it is written.
+    The download goes to a .part file that is resumed after a dropped
+    connection, or by the next worker, and only renamed into place once
+    complete. Returns the md5 and sha1 hex digests, or False if there is no
+    file or every attempt failed
+    """
+    create_directory(filepath)
+    part_path = filepath + ".part"
+    result = False
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            result = download_part(url, part_path)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            print("Download of " + url + " interrupted, attempt " + str(attempt + 1) + ": " + str(e))
+            result = False
+
+    if not result:
         return False
-    else:
-        create_directory(filepath)
-        open(filepath, 'wb').write(r.content)
-        return True
+
+    # Open.Media answers "false" for files it does not have
+    if os.path.getsize(part_path) == len(b"false"):
+        with open(part_path, 'rb') as f:
+            if f.read() == b"false":
+                remove_part(part_path)
+                return False
+
+    os.replace(part_path, filepath)
+    remove_part(part_path)
+    return result
 
 
 def download_youtube(url, filepath):
-    """Download an mp4 from YouTube url via youtube-dl and store to the provided filepath"""
+    """Download an mp4 from YouTube url via youtube-dl and store to the provided filepath.
+    youtube-dl keeps its own .part files and continues them on the next run,
+    the final path only appears once the download is complete"""
     create_directory(filepath)
     output_arg = "-f 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]'"
+    output_arg += " --continue --retries " + str(DOWNLOAD_ATTEMPTS)
     output_arg += " -o "
     output_arg += filepath
 
@@ -50,24 +153,34 @@ def download_youtube(url, filepath):
         return False
 
 
-def update_session_file_status(session_file, status):
-    """Update stored file status and properties based on state"""
+def session_file_status_data(session_file, status):
+    """Stored file status and properties to update based on state"""
     if status == c.FILE_PROCESSED:
         data = {
             'state': status,
             'md5': session_file.md5,
-            'id': session_file.id}
+            'sha1': session_file.sha1}
     elif status == c.FILE_FETCHED:
         data = {
             'state': status,
-            'filepath': session_file.filepath,
-            'id': session_file.id}
+            'filepath': session_file.filepath}
+        # streamed downloads are hashed on the way in
+        if session_file.md5:
+            data['md5'] = session_file.md5
+            data['sha1'] = session_file.sha1
     else:
         data = {
-            'state': status,
-            'id': session_file.id}
+            'state': status}
+    return data
 
-    ytarchive().filesUpdate(data)
+
+def update_session_files_status(changes):
+    """Update stored status and properties for many files at once from a
+    list of (session_file, status) pairs
+    """
+    ytarchive().filesUpdateMany({
+        session_file.id: session_file_status_data(session_file, status)
+        for session_file, status in changes})
 
 
 def session_file_extension(session_file_type):
@@ -95,51 +208,108 @@ def session_file_filepath(session_file, session_file_type):
     return filepath
 
 
-def download_session_files(session, session_files):
-    """Download and store all files associated with a session item"""
-    for key, session_file in enumerate(session_files):
-        update_session_file_status(session_file, c.FILE_FETCHING)
-        session_file_type = session_file.type.lower()
-        filepath = session_file_filepath(session_file, session_file_type)
-
-        # YouTube API does not expose mp4 url, so we use yt_download
-        if (session_file_type != "video"):
+def host_slot(url):
+    """Semaphore limiting concurrent downloads from the host serving url"""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            limit = settings().getint('process', 'host_concurrency', fallback=2)
+            _host_slots[host] = threading.BoundedSemaphore(limit)
+        return _host_slots[host]
+
+
+def download_session_file(session_file):
+    """Download a single session file, returning its new status"""
+    session_file_type = session_file.type.lower()
+    filepath = session_file_filepath(session_file, session_file_type)
+
+    # captions and cuepoints fetched by harvest are already staged
+    if staging.take(session_file, filepath):
+        result = True
+    # YouTube API does not expose mp4 url, so we use yt_download
+    elif (session_file_type != "video"):
+        with host_slot(session_file.url):
             result = download_file(session_file.url, filepath)
-        else:
+    else:
+        with host_slot(session_file.url):
             result = download_youtube(session_file.url, filepath)
 
-        if result:
-            session_file.filepath = filepath
-            session_files[key].filepath = filepath
-            update_session_file_status(session_file, c.FILE_FETCHED)
-            log(session_file, "File downloaded", c.FILE_FETCHED)
-        else:
-            # TODO: invalid is pretty vague, eventually we should provide more
-            # specific error handling around failed file downloads
-            session_files[key].state = c.FILE_INVALID
-            update_session_file_status(session_file, c.FILE_INVALID)
-            log(session_file, "File invalid or failed to download", c.FILE_INVALID, c.LOG_WARNING)
+    if result:
+        if isinstance(result, tuple):
+            session_file.md5, session_file.sha1 = result
+        session_file.filepath = filepath
+        update_session_files_status([(session_file, c.FILE_FETCHED)])
+        log(session_file, "File downloaded", c.FILE_FETCHED)
+        return c.FILE_FETCHED
+    else:
+        # TODO: invalid is pretty vague, eventually we should provide more
+        # specific error handling around failed file downloads
+        session_file.state = c.FILE_INVALID
+        update_session_files_status([(session_file, c.FILE_INVALID)])
+        log(session_file, "File invalid or failed to download", c.FILE_INVALID, c.LOG_WARNING)
+        return c.FILE_INVALID
+
+
+def download_session_files(session, session_files):
+    """Download and store all files associated with a session item. Files
+    are fetched concurrently so documents and SRTs arrive while the video
+    is still downloading"""
+    update_session_files_status([(session_file, c.FILE_FETCHING) for session_file in session_files])
+
+    # digests left from an earlier version of the file are no longer valid
+    for session_file in session_files:
+        session_file.md5 = None
+        session_file.sha1 = None
+
+    if not session_files:
+        return session_files
+
+    # start the video first, it sets how long the session takes
+    ordered = sorted(session_files, key=lambda session_file: session_file.type.lower() != "video")
+    concurrency = settings().getint('process', 'download_concurrency', fallback=4)
+    # each file records its own state as soon as it finishes
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(ordered)))) as executor:
+        list(executor.map(download_session_file, ordered))
+
     return session_files
 
 
-def md5(filepath):
-    """Generates an MD5 hash from provided filepath, supports large files"""
+def file_digests(filepath):
+    """Generates MD5 and SHA1 hashes from provided filepath in a single pass,
+    supports large files"""
     hash_md5 = hashlib.md5()
+    hash_sha1 = hashlib.sha1()
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+            hash_sha1.update(chunk)
+    return hash_md5.hexdigest(), hash_sha1.hexdigest()
 
 
 def hash_session_files(session, downloaded_session_files):
-    """Generate and store md5 hash for each downloaded file"""
-    for session_file in downloaded_session_files:
-        if session_file.state != c.FILE_INVALID:
-            update_session_file_status(session_file, c.FILE_PROCESSING)
-            hash_md5 = md5(session_file.filepath)
-            session_file.md5 = hash_md5
-            update_session_file_status(session_file, c.FILE_PROCESSED)
-            log(session_file, "File hashed", c.FILE_PROCESSED)
+    """Generate and store md5 and sha1 hashes for each downloaded file that
+    was not already hashed while streaming"""
+    session_files = [session_file for session_file in downloaded_session_files if session_file.state != c.FILE_INVALID]
+    update_session_files_status([(session_file, c.FILE_PROCESSING) for session_file in session_files])
+
+    for session_file in session_files:
+        if not session_file.md5:
+            session_file.md5, session_file.sha1 = file_digests(session_file.filepath)
+        update_session_files_status([(session_file, c.FILE_PROCESSED)])
+        log(session_file, "File hashed", c.FILE_PROCESSED)
+
+
+def process_session(updated_session):
+    """Download and hash the new and changed files of a claimed session"""
+    log(updated_session, "Files queued for download", c.SESSION_FETCHING)
+    updated_session_files = ytarchive().filesGetNewChanged(updated_session.id)
+    downloaded_session_files = download_session_files(updated_session, updated_session_files)
+    log(updated_session, "Files downloaded locally", c.SESSION_FETCHED)
+    ytarchive().sessionsExtendLease(updated_session)
+    ytarchive().sessionsUpdate({'id': updated_session.id, 'state': c.SESSION_PROCESSING})
+    hash_session_files(updated_session, downloaded_session_files)
+    ytarchive().sessionsRelease({'id': updated_session.id, 'state': c.SESSION_PROCESSED})
+    log(updated_session, "Files hashed", c.SESSION_PROCESSED)
 
 
 def process():
@@ -148,19 +318,13 @@ def process():
     if 'site' in args and args.site:
         site_id = args.site
 
-    """Download files and metadata for the oldest updated session"""
-    updated_session = ytarchive().sessionsGetChangedOldest(site_id)
+    """Download files and metadata for the oldest updated sessions, claiming
+    them first so other process workers skip them"""
+    updated_sessions = ytarchive().sessionsClaimChanged(site_id, limit=args.batch)
 
-    if updated_session:
-        ytarchive().sessionsUpdate({'id': updated_session.id, 'state': c.SESSION_FETCHING})
-        log(updated_session, "Files queued for download", c.SESSION_FETCHING)
-        updated_session_files = ytarchive().filesGetNewChanged(updated_session.id)
-        downloaded_session_files = download_session_files(updated_session, updated_session_files)
-        log(updated_session, "Files downloaded locally", c.SESSION_FETCHED)
-        ytarchive().sessionsUpdate({'id': updated_session.id, 'state': c.SESSION_PROCESSING})
-        hash_session_files(updated_session, downloaded_session_files)
-        ytarchive().sessionsUpdate({'id': updated_session.id, 'state': c.SESSION_PROCESSED})
-        log(updated_session, "Files hashed", c.SESSION_PROCESSED)
+    for updated_session in updated_sessions:
+        process_session(updated_session)
 
 
-process()
+if __name__ == '__main__':
+    process()
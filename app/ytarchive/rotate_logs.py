@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+import time
+from argparse import ArgumentParser
+from db import ytarchive, settings
+
+LOG_COLUMNS = ['id', 'site_id', 'session_id', 'file_id', 'type', 'severity', 'state', 'message', 'time']
+
+
+def get_rotate_args():
+    parser = ArgumentParser(description="Move logs older than the retention window into compressed segments and daily summaries")
+    parser.add_argument("-d", "--days", help="override the retention window in days", type=int)
+    return parser.parse_args()
+
+
+def log_record(log):
+    return {column: getattr(log, column) for column in LOG_COLUMNS}
+
+
+def summarize(records):
+    """Count rows per day, site, type, state and severity"""
+    summaries = {}
+    for record in records:
+        day = time.strftime('%Y-%m-%d', time.gmtime(record['time']))
+        key = (day, record['site_id'], record['type'], record['state'], record['severity'])
+        summaries[key] = summaries.get(key, 0) + 1
+    return summaries
+
+
+def segment_path(archive_dir, records):
+    """Segments are named by the id range they hold, so exporting the same
+    rows again after an interrupted run overwrites rather than duplicates
+    """
+    filename = "logs-%010d-%010d.ndjson.gz" % (records[0]['id'], records[-1]['id'])
+    return os.path.join(archive_dir, filename)
+
+
+def write_segment(archive_dir, records):
+    """Write rows to a gzipped NDJSON segment, made visible only once it is
+    complete and on disk
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    filepath = segment_path(archive_dir, records)
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+            for record in records:
+                f.write((json.dumps(record) + "\n").encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_filepath, filepath)
+    return filepath
+
+
+def rotate(cutoff, archive_dir, batch_size):
+    """Archive and summarize log rows written before cutoff a batch at a
+    time, deleting each batch once it is in a segment. Returns the number of
+    rows rotated
+    """
+    rotated = 0
+    while True:
+        logs = ytarchive().logsGetBefore(cutoff, batch_size)
+        if not logs:
+            break
+
+        records = [log_record(log) for log in logs]
+        filepath = write_segment(archive_dir, records)
+        ytarchive().logsCompact([record['id'] for record in records], summarize(records))
+        rotated += len(records)
+        print("Rotated " + str(len(records)) + " log rows to " + filepath)
+    return rotated
+
+
+def rotate_logs():
+    """Archive and summarize logs past the retention window, then delete them
+    from the database. Safe to run from cron; an interrupted run picks up
+    where it left off.
+    """
+    args = get_rotate_args()
+    config = settings()
+    retention_days = args.days or config.getint('logs', 'retention_days', fallback=90)
+    archive_dir = config.get('logs', 'archive_dir', fallback='/transfers/log_archive')
+    batch_size = config.getint('logs', 'rotate_batch_size', fallback=10000)
+    cutoff = int(time.time()) - retention_days * 24 * 60 * 60
+
+    rotated = rotate(cutoff, archive_dir, batch_size)
+    print("Rotated " + str(rotated) + " log rows older than " + str(retention_days) + " days")
+
+
+if __name__ == '__main__':
+    rotate_logs()
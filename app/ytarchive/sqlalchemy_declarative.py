@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Text
+from sqlalchemy import Column, Integer, String, Boolean, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from marshmallow_sqlalchemy import ModelSchema
 
@@ -19,6 +19,16 @@ class Session(Base):
     created = Column(Integer, nullable=False)
     last_updated = Column(Integer, nullable=False)
     validated = Column(Boolean, default=0)
+    claimed_by = Column(String(64))
+    lease_expires = Column(Integer)
+    fingerprint = Column(String(40))
+
+    __table_args__ = (
+        Index('ix_sessions_state_last_updated', 'state', 'last_updated'),
+        Index('ix_sessions_site_id_state_last_updated', 'site_id', 'state', 'last_updated'),
+        Index('ix_sessions_state_validated_last_updated', 'state', 'validated', 'last_updated'),
+        Index('ix_sessions_claimed_by', 'claimed_by'),
+    )
 
 
 class SessionSchema(ModelSchema):
@@ -35,7 +45,13 @@ class File(Base):
     url = Column(String(320), nullable=False)
     state = Column(String(32), nullable=False)
     md5 = Column(String(32))
+    sha1 = Column(String(40))
     validated = Column(Boolean, default=0)
+    fingerprint = Column(String(40))
+
+    __table_args__ = (
+        Index('ix_files_session_id_state', 'session_id', 'state'),
+    )
 
 
 class FileSchema(ModelSchema):
@@ -47,15 +63,55 @@ class Log(Base):
     __tablename__ = 'logs'
     id = Column(Integer, primary_key=True)
     site_id = Column(Integer)
-    file_id = Column(String(120), nullable=False)
+    file_id = Column(String(120))
     severity = Column(String(32), nullable=False)
     message = Column(String(320), nullable=False)
     state = Column(String(32), nullable=False)
     time = Column(Integer, nullable=False)
     type = Column(String(32), nullable=False)
-    session_id = Column(Integer, nullable=False)
+    session_id = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_logs_site_id_type_state_time', 'site_id', 'type', 'state', 'time'),
+        Index('ix_logs_session_id_state', 'session_id', 'state'),
+    )
 
 
 class LogSchema(ModelSchema):
     class Meta:
         model = Log
+
+
+class LogSummary(Base):
+    __tablename__ = 'log_summaries'
+    id = Column(Integer, primary_key=True)
+    day = Column(String(10), nullable=False)
+    site_id = Column(Integer)
+    type = Column(String(32), nullable=False)
+    state = Column(String(32), nullable=False)
+    severity = Column(String(32), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_log_summaries_day_site_id_type_state_severity', 'day', 'site_id', 'type', 'state', 'severity', unique=True),
+    )
+
+
+class LogSummarySchema(ModelSchema):
+    class Meta:
+        model = LogSummary
+
+
+class HarvestState(Base):
+    __tablename__ = 'harvest_state'
+    site_id = Column(Integer, primary_key=True, autoincrement=False)
+    created = Column(Integer, nullable=False)
+    updated = Column(Integer, nullable=False)
+    completed = Column(Integer, nullable=False)
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(320), nullable=False)
+    applied = Column(Integer, nullable=False)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+from os import path
+from db import settings
+
+
+def staging_directory():
+    return settings().get('harvest', 'staging_dir', fallback='/transfers/staging')
+
+
+def staged_path(file):
+    """Where harvest keeps a file it already fetched for a session file"""
+    return path.join(staging_directory(), str(file.session_id), str(file.id))
+
+
+def stage(file, content):
+    """Keep content fetched during harvest so process.py does not have to
+    download it again"""
+    filepath = staged_path(file)
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, filepath)
+
+
+def take(file, filepath):
+    """Move a staged copy of file to filepath, returns False if there is none"""
+    source = staged_path(file)
+    if not path.exists(source):
+        return False
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+    shutil.move(source, filepath)
+    return True
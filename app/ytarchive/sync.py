@@ -33,6 +33,11 @@ def update_file_status(file, status):
     ytarchive().filesUpdate({'id': file.id, 'state': status})
 
 
+def update_files_status(files, status):
+    """Move many stored session files to the same status in one update"""
+    ytarchive().filesUpdateMany({file.id: status for file in files})
+
+
 def finish_unchanged_files(archive_info, files):
     """Changes stored state of files with matching md5s to synced to prevent
     further processing
@@ -45,8 +50,8 @@ def finish_unchanged_files(archive_info, files):
                 if file.md5 == archive_file['md5']:
                     remove_files.append(file)
 
+    update_files_status(remove_files, c.SESSION_SYNCED)
     for remove_file in remove_files:
-        update_file_status(remove_file, c.SESSION_SYNCED)
         log(remove_file, "File unchanged, removed from queue", c.SESSION_SYNCED)
         files.remove(remove_file)
 
@@ -111,7 +116,7 @@ def prepare_archive_files(session_files):
     if session_files:
         for session_file in session_files:
             files.append(session_file.filepath)
-            update_file_status(session_file, c.FILE_SYNCING)
+        update_files_status(session_files, c.FILE_SYNCING)
 
     return files
 
@@ -122,7 +127,7 @@ def prepare_archive_file_names(session_files):
     if session_files:
         for session_file in session_files:
             files.append(path.basename(session_file.filepath))
-            update_file_status(session_file, c.FILE_DELETING)
+        update_files_status(session_files, c.FILE_DELETING)
 
     return files
 
@@ -190,7 +195,8 @@ def archive_update_metadata(archive_id, metadata, session):
     success = True
 
     m = modify_metadata(archive_id, metadata)
-    if m.status_code != 200:
+    # archive.org refuses an edit that changes nothing, that is not a failure
+    if m.status_code != 200 and "no changes" not in m.text:
         success = False
         log(session, "Failed to update metadata on archive.org: " + m.reason, c.SESSION_FAILED, c.LOG_ERROR)
     else:
@@ -237,8 +243,8 @@ def archive_delete_removed_files(archive_id, session_files, session):
         log(session, "No matching files found for deletion on archive.org", c.SESSION_DELETED, c.LOG_WARNING)
 
     if success:
+        update_files_status(session_files, c.FILE_DELETED)
         for session_file in session_files:
-            update_file_status(session_file, c.FILE_DELETED)
             log(session_file, "File deleted on archive.org", c.FILE_DELETED)
 
     return success
@@ -254,38 +260,71 @@ def session_archive_id(session):
     return archive_id
 
 
+def sync_session(session):
+    """Upload a claimed session's processed files and metadata to archive.org"""
+    log(session, "Session queued for archive.org sync", c.SESSION_SYNCING)
+
+    update_success = True
+    delete_success = True
+    archive_id = session_archive_id(session)
+    archive_info = False
+    # syncing files were left behind by a worker whose claim expired
+    session_files = ytarchive().filesGet(id=None, params={'session_id': session.id, 'state': c.FILE_PROCESSED + ',' + c.FILE_SYNCING})
+    # remove any unchanged files and mark them as finished
+    if session.archive_id:
+        archive_info = get_item(archive_id)
+        session_files = finish_unchanged_files(archive_info, session_files)
+    update_success = archive_update(archive_id, session, session_files, archive_info)
+
+    # remove any files no longer present on session
+    # note that we never delete videos or sessions for permanent backup
+    removed_session_files = ytarchive().filesGetRemoved(session.id)
+    if removed_session_files:
+        delete_success = archive_delete_removed_files(archive_id, removed_session_files, session)
+
+    if not delete_success:
+        update_session_status(session, c.SESSION_FAILED)
+        log(session, "Failed to delete items from archive.org", c.SESSION_FAILED, c.LOG_ERROR)
+
+    ytarchive().sessionsRelease({'id': session.id})
+    return update_success and delete_success
+
+
+def sync_session_metadata(session):
+    """Push changed metadata of an archived session to archive.org without
+    touching its files"""
+    log(session, "Session metadata queued for archive.org sync", c.SESSION_METADATA)
+
+    archive_id = session_archive_id(session)
+    metadata = prepare_archive_metadata(session)
+    if metadata_changed(metadata, get_item(archive_id)):
+        success = archive_update_metadata(archive_id, metadata, session)
+    else:
+        success = True
+        log(session, "Session metadata already current on archive.org", c.SESSION_SYNCED)
+
+    if success:
+        ytarchive().sessionsRelease({'id': session.id, 'state': c.SESSION_SYNCED})
+    else:
+        ytarchive().sessionsRelease({'id': session.id, 'state': c.SESSION_FAILED})
+    return success
+
+
 def sync():
+    site_id = None
     args = get_args()
-
     if 'site' in args and args.site:
-        session = ytarchive().sessionsGet(id=None, params={'state': c.SESSION_PROCESSED, 'site_id': args.site, 'sort': 'last_updated:asc', 'limit': 1})
-    else:
-        session = ytarchive().sessionsGet(id=None, params={'state': c.SESSION_PROCESSED, 'sort': 'last_updated:asc', 'limit': 1})
-
-    if session:
-        update_session_status(session, c.SESSION_SYNCING)
-        log(session, "Session queued for archive.org sync", c.SESSION_SYNCING)
-
-        update_success = True
-        delete_success = True
-        archive_id = session_archive_id(session)
-        archive_info = False
-        session_files = ytarchive().filesGet(id=None, params={'session_id': session.id, 'state': c.FILE_PROCESSED})
-        # remove any unchanged files and mark them as finished
-        if session.archive_id:
-            archive_info = get_item(archive_id)
-            session_files = finish_unchanged_files(archive_info, session_files)
-        update_success = archive_update(archive_id, session, session_files, archive_info)
-
-        # remove any files no longer present on session
-        # note that we never delete videos or sessions for permanent backup
-        removed_session_files = ytarchive().filesGetRemoved(session.id)
-        if removed_session_files:
-            delete_success = archive_delete_removed_files(archive_id, removed_session_files, session)
-
-        if not delete_success:
-            update_session_status(session, c.SESSION_FAILED)
-            log(session, "Failed to delete items from archive.org", c.SESSION_FAILED, c.LOG_ERROR)
-
-
-sync()
+        site_id = args.site
+
+    # metadata only changes are quick, send them before any file uploads
+    for session in ytarchive().sessionsClaimMetadata(site_id, limit=args.batch):
+        sync_session_metadata(session)
+
+    sessions = ytarchive().sessionsClaimProcessed(site_id, limit=args.batch)
+
+    for session in sessions:
+        sync_session(session)
+
+
+if __name__ == '__main__':
+    sync()
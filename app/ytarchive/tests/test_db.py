@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+os.environ['YTARCHIVE_DB_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db')
+
+from sqlalchemy import event  # noqa: E402
+import constants as c  # noqa: E402
+import db  # noqa: E402
+from db import ytarchive  # noqa: E402
+
+
+def make_session(id, site_id=1, state=c.SESSION_NEW, last_updated=0):
+    return {
+        'id': id,
+        'site_id': site_id,
+        'title': "Test session",
+        'state': state,
+        'created': 0,
+        'last_updated': last_updated}
+
+
+def make_log(session_id):
+    return {
+        'session_id': session_id,
+        'severity': c.LOG_STATUS,
+        'message': "Test log",
+        'state': c.SESSION_NEW,
+        'time': 0,
+        'type': 'session',
+        'site_id': 1}
+
+
+def test_logs_insert_returns_generated_ids():
+    logs = ytarchive().logsInsert([make_log(100) for i in range(1200)])
+    ids = [log['id'] for log in logs]
+    assert len(set(ids)) == 1200
+    assert ytarchive().logsGet(ids[-1]).session_id == 100
+    assert ids == list(range(ids[0], ids[0] + 1200))
+
+
+def test_files_update_many():
+    ytarchive().filesInsert([
+        {'id': 'test-update-' + str(i), 'session_id': 200, 'type': 'agenda', 'url': 'https://example.com', 'state': c.FILE_NEW}
+        for i in range(3)])
+    ytarchive().filesUpdateMany({
+        'test-update-0': c.FILE_SYNCED,
+        'test-update-1': {'state': c.FILE_PROCESSED, 'md5': 'abc'}})
+
+    files = {file.id: file for file in ytarchive().filesGet(params={'session_id': 200})}
+    assert files['test-update-0'].state == c.FILE_SYNCED
+    assert files['test-update-1'].state == c.FILE_PROCESSED
+    assert files['test-update-1'].md5 == 'abc'
+    assert files['test-update-2'].state == c.FILE_NEW
+
+
+def test_sessions_claim_is_exclusive():
+    ytarchive().sessionsInsert([make_session(300 + i, site_id=3, last_updated=i) for i in range(3)])
+    first = ytarchive().sessionsClaimChanged(site_id=3, limit=2)
+    second = ytarchive().sessionsClaimChanged(site_id=3, limit=2)
+
+    assert [session.id for session in first] == [300, 301]
+    assert [session.id for session in second] == [302]
+    assert all(session.state == c.SESSION_FETCHING for session in first + second)
+    assert ytarchive().sessionsClaimChanged(site_id=3) == []
+
+
+def test_sessions_claim_reclaims_expired_lease():
+    ytarchive().sessionsInsert(make_session(400, site_id=4))
+    claimed = ytarchive().sessionsClaimChanged(site_id=4)
+    ytarchive().sessionsUpdate({'id': claimed[0].id, 'lease_expires': 1})
+
+    reclaimed = ytarchive().sessionsClaimChanged(site_id=4)
+    assert [session.id for session in reclaimed] == [400]
+    assert reclaimed[0].claimed_by != claimed[0].claimed_by
+
+
+def test_sessions_get_page():
+    ytarchive().sessionsInsert([make_session(500 + i, site_id=5, last_updated=i // 2) for i in range(5)])
+    seen = []
+    cursor = None
+    while True:
+        params = {'site_id': 5, 'sort': 'last_updated:desc', 'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        sessions, cursor = ytarchive().sessionsGetPage(params)
+        seen += [session.id for session in sessions]
+        if not cursor:
+            break
+
+    assert seen == [504, 503, 502, 501, 500]
+
+
+def test_harvest_state_save_upserts():
+    assert ytarchive().harvestStateGet(600) is None
+    ytarchive().harvestStateSave(600, created=10, updated=20)
+    ytarchive().harvestStateSave(600, created=30, updated=40)
+
+    state = ytarchive().harvestStateGet(600)
+    assert (state.created, state.updated) == (30, 40)
+
+
+def test_sessions_get_states():
+    ytarchive().sessionsInsert([make_session(700 + i, site_id=7, last_updated=i) for i in range(3)])
+    states = {row.id: row for row in ytarchive().sessionsGetStates([700, 702, 799])}
+
+    assert sorted(states) == [700, 702]
+    assert (states[702].state, states[702].last_updated) == (c.SESSION_NEW, 2)
+
+
+def test_sessions_claim_metadata():
+    ytarchive().sessionsInsert(make_session(800, site_id=8, state=c.SESSION_METADATA))
+
+    assert ytarchive().sessionsClaimProcessed(site_id=8) == []
+    claimed = ytarchive().sessionsClaimMetadata(site_id=8)
+    assert [session.id for session in claimed] == [800]
+    assert claimed[0].state == c.SESSION_METADATA
+    assert ytarchive().sessionsClaimMetadata(site_id=8) == []
+
+
+def test_logs_insert_without_consecutive_ids(monkeypatch):
+    monkeypatch.setattr(db, '_consecutive_insert_ids', False)
+    logs = ytarchive().logsInsert([make_log(101) for i in range(5)])
+    ids = [log['id'] for log in logs]
+
+    assert len(set(ids)) == 5
+    assert all(ytarchive().logsGet(id).session_id == 101 for id in ids)
+
+
+def test_logs_insert_without_ids_stays_multi_row(monkeypatch):
+    monkeypatch.setattr(db, '_consecutive_insert_ids', False)
+    statements = []
+
+    def count_inserts(conn, cursor, statement, *args):
+        if statement.startswith('INSERT'):
+            statements.append(statement)
+    event.listen(db.get_engine(), 'before_cursor_execute', count_inserts)
+    try:
+        logs = ytarchive().logsInsert([make_log(102) for i in range(5)], return_ids=False)
+    finally:
+        event.remove(db.get_engine(), 'before_cursor_execute', count_inserts)
+
+    assert len(statements) == 1
+    assert all('id' not in log for log in logs)
+    assert len(ytarchive().logsGet(params={'session_id': 102})) == 5
+
+
+def test_settings_are_loaded_once():
+    db.settings().read_dict({'test_settings': {'value': '1'}})
+    assert db.settings() is db.settings()
+    assert db.settings().get('test_settings', 'value') == '1'
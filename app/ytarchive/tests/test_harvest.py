@@ -1,13 +1,117 @@
 #!/usr/bin/env python3
-import harvest
-import om_api
-from models import Session
+import os
+import tempfile
+os.environ.setdefault('YTARCHIVE_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db'))
+
+import constants as c  # noqa: E402
+import harvest  # noqa: E402
+import om_api  # noqa: E402
+from db import ytarchive, settings  # noqa: E402
+from models import Session  # noqa: E402
 test_session_id = 43260
 test_site_id = 1
 
+settings().read_dict({'harvest': {'staging_dir': tempfile.mkdtemp()}})
+test_site = {'site_id': '9', 'om_user_settings_archive_collection': 'test-collection', 'group': 'Test group'}
+
 
 def test_get_session_files_metadata_video():
     session = om_api.Sessions().get(session_id=test_session_id)
     session = Session(session)
     files = harvest.get_session_files_metadata(session)
     assert files[0].id == '3QtFoVNX1V0'
+
+
+def make_live_session(id, updated=1600000000, title="Test session"):
+    return {
+        'id': str(id),
+        'site_id': test_site['site_id'],
+        'created': '1600000000',
+        'updated': str(updated),
+        'cuepoints_updated': '0',
+        'minutes_status': '0',
+        'title': title,
+        'date': '1600000000',
+        'archive_id': None,
+        'categories': [],
+        'documents': [{'id': id, 'type': 'Agenda', 'url': 'https://example.com/' + str(id) + '.pdf'}]}
+
+
+def stub_sessions(monkeypatch, new=None, updated=None, unprocessed=None):
+    """Serve fixed session lists in place of the Open.Media sessions API"""
+    class Sessions():
+        def iterate(self, archived=None, dropped=None, **filters):
+            if archived == "false" and dropped is not None:
+                dropped.extend(unprocessed or [])
+            return iter((new if archived == "false" else updated) or [])
+    monkeypatch.setattr(om_api, 'Sessions', Sessions)
+
+
+def test_store_sessions_new_session(monkeypatch):
+    stub_sessions(monkeypatch, new=[make_live_session(90001)])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+
+    assert (results['new'], results['updated']) == (1, 0)
+    assert ytarchive().sessionsGet(90001).state == c.SESSION_NEW
+    assert [file.id for file in ytarchive().filesGet(params={'session_id': 90001})] == ['doc-agenda-90001']
+
+    # already stored, so the next run only looks at updated sessions
+    stub_sessions(monkeypatch, new=[make_live_session(90001)])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+    assert (results['new'], results['updated']) == (0, 0)
+
+
+def test_store_sessions_metadata_only_change(monkeypatch):
+    stub_sessions(monkeypatch, new=[make_live_session(90002)])
+    harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+    ytarchive().sessionsUpdate({'id': 90002, 'state': c.SESSION_SYNCED, 'validated': True})
+    ytarchive().filesUpdateMany({'doc-agenda-90002': {'state': c.FILE_SYNCED, 'validated': True}})
+
+    stub_sessions(monkeypatch, updated=[make_live_session(90002, updated=1600000100, title="Renamed")])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+
+    session = ytarchive().sessionsGet(90002)
+    assert results['updated'] == 1
+    assert (session.state, session.title, session.validated) == (c.SESSION_METADATA, "Renamed", True)
+
+
+def test_store_sessions_adopts_missing_file_fingerprint(monkeypatch):
+    stub_sessions(monkeypatch, new=[make_live_session(90003)])
+    harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+    ytarchive().sessionsUpdate({'id': 90003, 'state': c.SESSION_SYNCED, 'validated': True})
+    # synced before fingerprints were recorded
+    ytarchive().filesUpdateMany({'doc-agenda-90003': {'state': c.FILE_SYNCED, 'validated': True, 'fingerprint': None}})
+
+    stub_sessions(monkeypatch, updated=[make_live_session(90003, updated=1600000100)])
+    harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+
+    file = ytarchive().filesGet('doc-agenda-90003')
+    assert (file.state, file.validated) == (c.FILE_SYNCED, True)
+    assert file.fingerprint is not None
+
+
+def test_store_sessions_unmanaged_session(monkeypatch):
+    session = make_live_session(90004)
+    session['archive_id'] = 'managed-elsewhere'
+    stub_sessions(monkeypatch, new=[session])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+
+    assert results['skipped'] == 1
+    assert ytarchive().sessionsGet(90004).state == c.SESSION_UNMANAGED
+    assert ytarchive().filesGet(params={'session_id': 90004}) == []
+
+    # later Open.Media edits leave it alone
+    stub_sessions(monkeypatch, updated=[make_live_session(90004, updated=1600000100)])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+    assert results['skipped'] == 1
+    assert ytarchive().sessionsGet(90004).state == c.SESSION_UNMANAGED
+
+
+def test_store_sessions_created_mark_waits_for_unprocessed_video(monkeypatch):
+    stub_sessions(monkeypatch,
+                  new=[make_live_session(90005), dict(make_live_session(90006), created='1600000900')],
+                  unprocessed=[dict(make_live_session(90007), created='1600000500')])
+    results = harvest.store_sessions(test_site, {'created': 0, 'updated': 0})
+
+    assert results['new'] == 2
+    assert results['watermarks']['created'] == 1600000499
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+import json
+import os
+import tempfile
+os.environ.setdefault('YTARCHIVE_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db'))
+
+import log  # noqa: E402
+
+
+def test_fit_columns_truncates_long_messages():
+    data = log.fit_columns({'message': "x" * 1000, 'state': "new", 'time': 0})
+    assert data['message'] == "x" * 320
+    assert data['state'] == "new"
+
+
+def test_rejected_rows_are_not_replayed():
+    directory = tempfile.mkdtemp()
+    writer = log.LogWriter.__new__(log.LogWriter)
+    writer.spill_path = os.path.join(directory, 'spill.ndjson')
+    writer.rejected_path = os.path.join(directory, 'rejected.ndjson')
+    writer.spill([{'message': "bad row"}], writer.rejected_path)
+
+    assert not os.path.exists(writer.spill_path)
+    with open(writer.rejected_path) as f:
+        assert json.loads(f.readline())['message'] == "bad row"
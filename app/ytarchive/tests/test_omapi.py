@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import tempfile
+import pytest
+import requests
 import om_api
 test_session_id = 43260
 test_site_id = 1
@@ -32,3 +35,105 @@ def test_om_api_captions_list():
 def test_om_api_cuepoints_list():
     cuepoints = om_api.Cuepoints().list(session_id=test_session_id)
     assert len(cuepoints) > 0
+
+
+class StubResponse():
+    def __init__(self, results):
+        self.results = results
+
+    def json(self):
+        return {'results': self.results}
+
+
+def stub_sessions_api(monkeypatch, honours_offset, max_limit=None):
+    """Serve eight sessions, optionally ignoring the offset parameter or
+    capping the page size at max_limit"""
+    sessions = [{'id': id} for id in range(8)]
+
+    def httpGet(self, url, params=None):
+        if 'limit' not in params:
+            return StubResponse(sessions)
+        offset = params['offset'] if honours_offset else 0
+        limit = min(params['limit'], max_limit or params['limit'])
+        return StubResponse(sessions[offset:offset + limit])
+
+    if not om_api.get_config().has_section('om_api'):
+        om_api.get_config().read_dict({'om_api': {'url': 'https://example.com', 'key': 'test'}})
+    monkeypatch.setattr(om_api, 'page_size', lambda: 3)
+    monkeypatch.setattr(om_api.OmApi, 'httpGet', httpGet)
+
+
+def test_om_api_sessions_iterate_pages(monkeypatch):
+    stub_sessions_api(monkeypatch, honours_offset=True)
+    assert [session['id'] for session in om_api.Sessions().iterate(site_id=1)] == list(range(8))
+
+
+def test_om_api_sessions_iterate_capped_page_size(monkeypatch):
+    stub_sessions_api(monkeypatch, honours_offset=True, max_limit=2)
+    assert [session['id'] for session in om_api.Sessions().iterate(site_id=1)] == list(range(8))
+
+
+def test_om_api_sessions_iterate_without_offset_support(monkeypatch):
+    stub_sessions_api(monkeypatch, honours_offset=False)
+    assert [session['id'] for session in om_api.Sessions().iterate(site_id=1)] == list(range(8))
+
+
+class StubContentResponse():
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.ok = status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.exceptions.HTTPError(str(self.status_code))
+
+
+def test_om_api_srt_revalidates_cached_copy(monkeypatch):
+    srt = b"1\n00:00:00,000 --> 00:00:01,000\nCall to order\n"
+    requests = []
+
+    class StubHttp():
+        def get(self, url, params=None, headers=None, timeout=None):
+            requests.append(headers)
+            if headers.get('If-None-Match') == '"v1"':
+                return StubContentResponse(304)
+            return StubContentResponse(200, srt, {'ETag': '"v1"'})
+
+    if not om_api.get_config().has_section('om_api'):
+        om_api.get_config().read_dict({'om_api': {'url': 'https://example.com', 'key': 'test'}})
+    monkeypatch.setattr(om_api, '_response_cache', om_api.ResponseCache(tempfile.mkdtemp(), 1024 * 1024))
+    monkeypatch.setattr(om_api, 'get_http', lambda: StubHttp())
+
+    assert om_api.Captions().srt(session_id=1) == srt
+    assert om_api.Captions().srt(session_id=1) == srt
+    assert requests == [{}, {'If-None-Match': '"v1"'}]
+
+
+def test_om_api_srt_server_error_is_not_content(monkeypatch):
+    class StubHttp():
+        def get(self, url, params=None, headers=None, timeout=None):
+            return StubContentResponse(502, b"<html>Bad Gateway</html>", {'ETag': '"error"'})
+
+    if not om_api.get_config().has_section('om_api'):
+        om_api.get_config().read_dict({'om_api': {'url': 'https://example.com', 'key': 'test'}})
+    cache = om_api.ResponseCache(tempfile.mkdtemp(), 1024 * 1024)
+    monkeypatch.setattr(om_api, '_response_cache', cache)
+    monkeypatch.setattr(om_api, 'get_http', lambda: StubHttp())
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        om_api.Captions().srt(session_id=2)
+    assert cache.index() == {}
+
+
+def test_om_api_filter_processed_reports_dropped(monkeypatch):
+    sessions = [{'id': 1, 'video_url': 'a'}, {'id': 2, 'video_url': 'b'}, {'id': 3}]
+    monkeypatch.setattr(om_api, 'processed_statuses', lambda sessions: [True, False])
+    if not om_api.get_config().has_section('om_api'):
+        om_api.get_config().read_dict({'om_api': {'url': 'https://example.com', 'key': 'test'}})
+
+    dropped = []
+    kept = om_api.Sessions().filterProcessed(sessions, video_processed=True, dropped=dropped)
+    assert [session['id'] for session in kept] == [1]
+    assert [session['id'] for session in dropped] == [2, 3]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import tempfile
+os.environ.setdefault('YTARCHIVE_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db'))
+
+import process  # noqa: E402
+
+test_url = 'https://example.com/agenda.pdf'
+
+
+class StubResponse():
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size=None):
+        yield self.content
+
+
+def stub_server(monkeypatch, *responses):
+    """Answer each requests.get with the next response, recording the
+    request headers"""
+    requests = []
+    responses = list(responses)
+
+    def get(url, headers=None, **kwargs):
+        requests.append(headers)
+        return responses.pop(0)
+    monkeypatch.setattr(process.requests, 'get', get)
+    return requests
+
+
+def make_part(filepath, content, source):
+    with open(filepath + ".part", 'wb') as f:
+        f.write(content)
+    if source:
+        with open(filepath + ".part.source", 'w') as f:
+            json.dump(source, f)
+
+
+def digests(content):
+    return hashlib.md5(content).hexdigest(), hashlib.sha1(content).hexdigest()
+
+
+def read(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+def test_download_file_fresh(monkeypatch):
+    filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+    requests = stub_server(monkeypatch, StubResponse(200, b"hello world", {'ETag': '"v1"'}))
+
+    assert process.download_file(test_url, filepath) == digests(b"hello world")
+    assert requests == [{}]
+    assert read(filepath) == b"hello world"
+    assert not os.path.exists(filepath + ".part") and not os.path.exists(filepath + ".part.source")
+
+
+def test_download_file_resumes_part(monkeypatch):
+    filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+    make_part(filepath, b"hello ", {'url': test_url, 'validator': '"v1"'})
+    requests = stub_server(monkeypatch, StubResponse(206, b"world"))
+
+    assert process.download_file(test_url, filepath) == digests(b"hello world")
+    assert requests == [{'Range': 'bytes=6-', 'If-Range': '"v1"'}]
+    assert read(filepath) == b"hello world"
+
+
+def test_download_file_restarts_changed_file(monkeypatch):
+    filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+    make_part(filepath, b"hello ", {'url': test_url, 'validator': '"v1"'})
+    # If-Range did not match, so the server sends the whole new file
+    stub_server(monkeypatch, StubResponse(200, b"new agenda", {'ETag': '"v2"'}))
+
+    assert process.download_file(test_url, filepath) == digests(b"new agenda")
+    assert read(filepath) == b"new agenda"
+
+
+def test_download_file_retries_unsatisfiable_range(monkeypatch):
+    filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+    make_part(filepath, b"hello world, longer", {'url': test_url, 'validator': '"v1"'})
+    requests = stub_server(monkeypatch, StubResponse(416), StubResponse(200, b"hello world", {'ETag': '"v1"'}))
+
+    assert process.download_file(test_url, filepath) == digests(b"hello world")
+    assert requests == [{'Range': 'bytes=19-', 'If-Range': '"v1"'}, {}]
+    assert read(filepath) == b"hello world"
+
+
+def test_download_file_discards_part_from_other_source(monkeypatch):
+    for source in ({'url': 'https://example.com/minutes.pdf', 'validator': '"v1"'},
+                   {'url': test_url, 'validator': None},
+                   None):
+        filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+        make_part(filepath, b"stale ", source)
+        requests = stub_server(monkeypatch, StubResponse(200, b"hello world"))
+
+        assert process.download_file(test_url, filepath) == digests(b"hello world")
+        assert requests == [{}]
+        assert read(filepath) == b"hello world"
+
+
+def test_download_file_missing(monkeypatch):
+    filepath = os.path.join(tempfile.mkdtemp(), 'agenda.pdf')
+    stub_server(monkeypatch, StubResponse(404))
+
+    assert process.download_file(test_url, filepath) is False
+    assert not os.path.exists(filepath)
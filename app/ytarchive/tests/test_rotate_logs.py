@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import os
+import tempfile
+os.environ.setdefault('YTARCHIVE_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db'))
+
+import constants as c  # noqa: E402
+import rotate_logs  # noqa: E402
+from db import ytarchive  # noqa: E402
+from sqlalchemy_declarative import Log, LogSummary  # noqa: E402
+
+# 2021-01-01 12:00 UTC
+old_time = 1609502400
+cutoff = old_time + 86400
+test_site_id = 70
+
+
+def make_log(time, state=c.SESSION_SYNCED):
+    return {
+        'session_id': 700,
+        'site_id': test_site_id,
+        'severity': c.LOG_STATUS,
+        'message': "Test log",
+        'state': state,
+        'time': time,
+        'type': 'session'}
+
+
+def read_segments(archive_dir):
+    records = []
+    for filename in sorted(os.listdir(archive_dir)):
+        with gzip.open(os.path.join(archive_dir, filename), 'rt') as f:
+            records += [json.loads(line) for line in f]
+    return records
+
+
+def site_summaries():
+    rows = ytarchive().db.query(LogSummary.day, LogSummary.state, LogSummary.count).filter_by(site_id=test_site_id).all()
+    ytarchive().db.close()
+    return {(day, state): count for day, state, count in rows}
+
+
+def site_log_times():
+    rows = ytarchive().db.query(Log.time).filter_by(site_id=test_site_id).all()
+    ytarchive().db.close()
+    return sorted(time for time, in rows)
+
+
+def test_rotate_archives_summarizes_and_deletes_old_rows():
+    ytarchive().logsInsert([make_log(old_time), make_log(old_time + 60), make_log(old_time, c.SESSION_FAILED),
+                            make_log(cutoff), make_log(cutoff + 60)])
+    archive_dir = tempfile.mkdtemp()
+
+    rotate_logs.rotate(cutoff, archive_dir, batch_size=2)
+
+    records = [record for record in read_segments(archive_dir) if record['site_id'] == test_site_id]
+    assert sorted((record['time'], record['state']) for record in records) == [
+        (old_time, c.SESSION_FAILED), (old_time, c.SESSION_SYNCED), (old_time + 60, c.SESSION_SYNCED)]
+    assert all(record['message'] == "Test log" for record in records)
+    assert site_summaries() == {('2021-01-01', c.SESSION_SYNCED): 2, ('2021-01-01', c.SESSION_FAILED): 1}
+    # rows at or after the cutoff stay in the database
+    assert site_log_times() == [cutoff, cutoff + 60]
+
+    # a later run adds to the existing daily counts
+    ytarchive().logsInsert([make_log(old_time + 120)])
+    rotate_logs.rotate(cutoff, tempfile.mkdtemp(), batch_size=2)
+
+    assert site_summaries() == {('2021-01-01', c.SESSION_SYNCED): 3, ('2021-01-01', c.SESSION_FAILED): 1}
+    assert site_log_times() == [cutoff, cutoff + 60]
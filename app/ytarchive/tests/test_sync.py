@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+os.environ.setdefault('YTARCHIVE_DB_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ytarchive.db'))
+
+import constants as c  # noqa: E402
+import sync  # noqa: E402
+from db import ytarchive  # noqa: E402
+
+
+class StubItem():
+    def __init__(self, metadata):
+        self.item_metadata = {'metadata': metadata, 'files': []}
+
+
+class StubResponse():
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+        self.reason = text
+
+
+def claim_metadata_session(id):
+    ytarchive().sessionsInsert({
+        'id': id,
+        'site_id': 7,
+        'group': "Test group",
+        'archive_collection_id': 'test-collection',
+        'archive_id': 'om-7-' + str(id),
+        'title': "Test session",
+        'category': "Meetings",
+        'state': c.SESSION_METADATA,
+        'created': 1600000000,
+        'last_updated': 1600000000})
+    return ytarchive().sessionsClaimMetadata(site_id=7)[0]
+
+
+def stub_archive(monkeypatch, archived_metadata, response):
+    calls = []
+
+    def modify_metadata(archive_id, metadata):
+        calls.append(archive_id)
+        return response
+    monkeypatch.setattr(sync, 'get_item', lambda archive_id: StubItem(archived_metadata))
+    monkeypatch.setattr(sync, 'modify_metadata', modify_metadata)
+    return calls
+
+
+def test_sync_session_metadata_skips_unchanged_metadata(monkeypatch):
+    session = claim_metadata_session(95001)
+    calls = stub_archive(monkeypatch, sync.prepare_archive_metadata(session), StubResponse(400, "no changes to _meta.xml"))
+
+    assert sync.sync_session_metadata(session)
+    assert calls == []
+    assert ytarchive().sessionsGet(95001).state == c.SESSION_SYNCED
+
+
+def test_sync_session_metadata_no_changes_response_is_success(monkeypatch):
+    session = claim_metadata_session(95002)
+    calls = stub_archive(monkeypatch, {'title': "Old title"}, StubResponse(400, "no changes to _meta.xml"))
+
+    assert sync.sync_session_metadata(session)
+    assert calls == ['om-7-95002']
+    assert ytarchive().sessionsGet(95002).state == c.SESSION_SYNCED
+
+
+def test_sync_session_metadata_failure(monkeypatch):
+    session = claim_metadata_session(95003)
+    stub_archive(monkeypatch, {'title': "Old title"}, StubResponse(503, "Service Unavailable"))
+
+    assert not sync.sync_session_metadata(session)
+    assert ytarchive().sessionsGet(95003).state == c.SESSION_FAILED
@@ -38,8 +38,11 @@ CREATE TABLE `files` (
   `state` varchar(32) NOT NULL,
   `id` varchar(120) NOT NULL,
   `md5` varchar(32) DEFAULT NULL,
+  `sha1` varchar(40) DEFAULT NULL,
   `validated` tinyint(1) DEFAULT '0',
-  PRIMARY KEY (`id`)
+  `fingerprint` varchar(40) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_files_session_id_state` (`session_id`,`state`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -63,7 +66,14 @@ CREATE TABLE `sessions` (
   `created` int(11) NOT NULL,
   `last_updated` int(11) NOT NULL,
   `validated` tinyint(1) DEFAULT '0',
-  PRIMARY KEY (`id`)
+  `claimed_by` varchar(64) DEFAULT NULL,
+  `lease_expires` int(11) DEFAULT NULL,
+  `fingerprint` varchar(40) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_sessions_state_last_updated` (`state`,`last_updated`),
+  KEY `ix_sessions_site_id_state_last_updated` (`site_id`,`state`,`last_updated`),
+  KEY `ix_sessions_state_validated_last_updated` (`state`,`validated`,`last_updated`),
+  KEY `ix_sessions_claimed_by` (`claimed_by`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -84,9 +94,71 @@ CREATE TABLE `logs` (
   `type` varchar(32) NOT NULL,
   `session_id` int(10) DEFAULT NULL,
   `site_id` int(10) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `ix_logs_site_id_type_state_time` (`site_id`,`type`,`state`,`time`),
+  KEY `ix_logs_session_id_state` (`session_id`,`state`)
 ) ENGINE=InnoDB AUTO_INCREMENT=470 DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `log_summaries`
+--
+
+DROP TABLE IF EXISTS `log_summaries`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `log_summaries` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `day` varchar(10) NOT NULL,
+  `site_id` int(11) DEFAULT NULL,
+  `type` varchar(32) NOT NULL,
+  `state` varchar(32) NOT NULL,
+  `severity` varchar(32) NOT NULL,
+  `count` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ix_log_summaries_day_site_id_type_state_severity` (`day`,`site_id`,`type`,`state`,`severity`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `harvest_state`
+--
+
+DROP TABLE IF EXISTS `harvest_state`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `harvest_state` (
+  `site_id` int(11) NOT NULL,
+  `created` int(11) NOT NULL,
+  `updated` int(11) NOT NULL,
+  `completed` int(11) NOT NULL,
+  PRIMARY KEY (`site_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `schema_migrations`
+--
+
+DROP TABLE IF EXISTS `schema_migrations`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `schema_migrations` (
+  `version` int(11) NOT NULL,
+  `description` varchar(320) NOT NULL,
+  `applied` int(11) NOT NULL,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+-- migrations already included in this schema
+INSERT INTO `schema_migrations` VALUES
+  (1,'Indexes for work queue, file and log lookups',0),
+  (2,'Session claims and leases for concurrent workers',0),
+  (3,'Daily log summaries kept after old logs are rotated out',0),
+  (4,'Per-site harvest watermarks',0),
+  (5,'Session and file fingerprints',0),
+  (6,'File SHA-1 digests',0);
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;